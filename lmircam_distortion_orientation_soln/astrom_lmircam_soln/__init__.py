@@ -1,9 +1,15 @@
 # created by E.S., 22 Nov 2016
 
 import os
+import numpy as np
 
 path=os.path.dirname(__file__)
 
+# data types: LMIRCam raw frames are 16-bit, so frames, coordinate maps and outputs are kept in
+# frame_dtype without losing anything; sums, means and other accumulators use accum_dtype
+frame_dtype = np.float32
+accum_dtype = np.float64
+
 dateStringAsterism = 'ut_2016_11_12'
 dateStringPinholes = 'ut_2016_11_22'
 generalStem = os.path.expanduser('~')+'/../../media/unasemaje/Seagate Expansion Drive/lbti_data_reduction/lmircam_astrometry/'
@@ -1,9 +1,28 @@
+import os
+import shutil
+import functools
+import hashlib
+import tempfile
+import warnings
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import numpy as np
+from scipy import sparse
 from scipy.ndimage import map_coordinates
+from astropy.io import fits
+from astrom_lmircam_soln import frame_dtype
+try:
+    import numba
+except ImportError: # numba is optional; without it the numba backend falls back to scipy
+    numba = None
 
 # added sparse grid option, 2016 Dec 09, E.S.
 
-def dewarp(image,P,Q,order=3):
+# full LMIRCam detector; subarray readouts are windows onto this
+detector_shape = (2048, 2048)
+
+def dewarp(image,P,Q,order=3,window=None,kernel=None,dtype=np.float64,conserveFlux=False):
     '''2d polynomial dewarping. Output x,y are mapped to input xt, yt
     according to:
     xt=F(x,y|P)
@@ -13,20 +32,210 @@ def dewarp(image,P,Q,order=3):
     INPUTS:
     image: 2D array
     P:   2D array of polynomial coefficients for generating xt from x
-    Q:   2D array of polynomial coefficients for generating yt from y'''
-    sh=image.shape
-    xt=np.polynomial.polynomial.polygrid2d([range(sh[0])],[range(sh[1])],P)
-    yt=np.polynomial.polynomial.polygrid2d([range(sh[0])],[range(sh[1])],Q)
-    return map_coordinates(image,[yt,xt],order=order)
+    Q:   2D array of polynomial coefficients for generating yt from y
+    window: (y, x) detector position of pixel (0,0) of image, if it is a
+            subarray readout (see get_readout_window)
+    kernel: None to interpolate with splines of the given order, or one of
+            interpolation_kernels ('nearest', 'bilinear', 'bicubic',
+            'lanczos3') to use precomputed weight tables instead (see
+            benchmark_dewarp_kernels.py for their speed and accuracy)
+    dtype: type of the coordinate maps; with float32 maps and a float32
+           image, the output is float32 too
+    conserveFlux: if True, scale the output by the pixel area of the map
+                  (the Jacobian determinant, see make_dewarp_coordinates),
+                  so that fluxes are preserved
+    The coordinates are cached (see get_dewarp_coordinates), so calling
+    this repeatedly with the same P, Q and geometry is cheap.'''
+    jac = None
+    if conserveFlux:
+        jac = get_dewarp_coordinates(image.shape,P,Q,window,dtype,jacobian=True)[1]
+    if kernel is not None:
+        op, outshape = get_dewarp_operator(image.shape,P,Q,window,kernel)
+        dewarped = np.reshape(dewarp_with_operator(image,op,outshape),
+                              (1,image.shape[0],1,image.shape[1]))
+        return dewarped if jac is None else _scale_by_jacobian(dewarped,jac)
+    return dewarp_with_precomputed_coords(image,get_dewarp_coordinates(image.shape,P,Q,window,dtype),
+                                          order=order,jacobian=jac)
 
-def make_dewarp_coordinates(imshape,P,Q):
+def make_dewarp_coordinates(imshape,P,Q,window=None,dtype=np.float64,jacobian=False):
     '''the xt and yt don't need be computed everytime if the 
     coefficients aren't changing. Use this function to compute 
     them, and use the function dewarp_with_precomputed_coords
-    to affect the distortion correction'''
-    xt=np.polynomial.polynomial.polygrid2d([range(imshape[0])],[range(imshape[1])],P)
-    yt=np.polynomial.polynomial.polygrid2d([range(imshape[0])],[range(imshape[1])],Q)
-    return [yt, xt]
+    to affect the distortion correction.
+    For a subarray readout, window is the (y, x) detector position of
+    its pixel (0,0); the polynomials are then evaluated at the detector
+    positions of the subarray pixels only, and the coordinates returned
+    are relative to the subarray.
+    The polynomials are always evaluated in float64; dtype is the type of
+    the maps returned (float32 halves their size, and keeps them to
+    better than a milli-pixel; see test_float32_coords).
+    If jacobian is True, this also returns the determinant of the Jacobian
+    of the map (from the analytic derivatives of the polynomials), i.e. the
+    area in the raw frame of each output pixel, which is the factor that
+    keeps fluxes right after dewarping: returns [yt, xt], jac'''
+    _check_window(imshape,window)
+    y0, x0 = (0, 0) if window is None else window
+    xt=np.polynomial.polynomial.polygrid2d([range(y0,y0+imshape[0])],[range(x0,x0+imshape[1])],P)-x0
+    yt=np.polynomial.polynomial.polygrid2d([range(y0,y0+imshape[0])],[range(x0,x0+imshape[1])],Q)-y0
+    coords = [yt.astype(dtype,copy=False), xt.astype(dtype,copy=False)]
+    if not jacobian:
+        return coords
+    polyder = np.polynomial.polynomial.polyder
+    derivs = [np.polynomial.polynomial.polygrid2d([range(y0,y0+imshape[0])],[range(x0,x0+imshape[1])],
+                                                  polyder(coeffs,axis=axis))
+              for coeffs, axis in ((P,1), (P,0), (Q,1), (Q,0))] # dxt/dx, dxt/dy, dyt/dx, dyt/dy
+    jac = derivs[0]*derivs[3]-derivs[1]*derivs[2]
+    return coords, jac.astype(dtype,copy=False)
+
+def _check_window(imshape,window):
+    # a subarray readout has to lie on the detector
+    if window is None:
+        return
+    y0, x0 = window
+    if y0 < 0 or x0 < 0 or y0+imshape[0] > detector_shape[0] or x0+imshape[1] > detector_shape[1]:
+        raise ValueError('a %ix%i frame at window (%i, %i) runs off the %ix%i detector'
+                         % (imshape[0], imshape[1], y0, x0, detector_shape[0], detector_shape[1]))
+
+def get_readout_window(header,keywords=('LTV2','LTV1')):
+    '''(y, x) detector position of pixel (0,0) of a (subarray) frame,
+    from its FITS header. By default this uses the IRAF LTV1/LTV2
+    keywords (offset of the image relative to the detector, i.e. minus
+    the window position); other keyword pairs can be given. Returns None
+    (full frame) if the keywords are missing.'''
+    if keywords[0] not in header or keywords[1] not in header:
+        return None
+    return (-int(round(header[keywords[0]])), -int(round(header[keywords[1]])))
+
+class LRUCache(object):
+    '''in-process cache that keeps the arrays it holds within a memory
+    budget (bytes), by dropping the least recently used entries'''
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.totalBytes = 0
+        self._entries = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        # returns None if the key isn't cached
+        if key not in self._entries:
+            return None
+        value, size = self._entries.pop(key)
+        self._entries[key] = (value, size) # now the most recently used
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            self.totalBytes -= self._entries.pop(key)[1]
+        size = _nbytes(value)
+        if size > self.maxBytes: # would push out everything else, so don't keep it
+            warnings.warn('not caching a %.2f GB entry, over the %.2f GB budget; it will be rebuilt on every call '
+                          '(see set_dewarp_cache_budget)' % (size/1e9, self.maxBytes/1e9))
+            return
+        self._entries[key] = (value, size)
+        self.totalBytes += size
+        self.evict()
+
+    def evict(self):
+        while self.totalBytes > self.maxBytes:
+            key, (value, size) = self._entries.popitem(last=False)
+            self.totalBytes -= size
+
+    def clear(self):
+        self._entries.clear()
+        self.totalBytes = 0
+
+def _nbytes(value):
+    # memory held by arrays, sparse matrices, and lists/tuples of them
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if sparse.issparse(value):
+        return value.data.nbytes+value.indices.nbytes+value.indptr.nbytes
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(item) for item in value)
+    return 0
+
+# coordinate maps (and interpolation operators) already computed, keyed by
+# geometry, coefficients and dtype. For the full detector, a pair of float64
+# maps is 64 MB (float32: 32 MB), and the operators from get_dewarp_operator
+# (float32 weights and int32 indices for every tap of every output pixel) are
+#   'nearest', 'bilinear' (4 taps): 0.15 GB
+#   'bicubic' (16 taps): 0.55 GB
+#   'lanczos3' (36 taps): 1.23 GB
+# so the default budget holds a full-frame lanczos3 operator along with the
+# coordinate maps it was made from
+dewarp_cache = LRUCache(2*1024**3)
+
+def set_dewarp_cache_budget(maxBytes):
+    '''set the memory budget (bytes) of the coordinate map cache (see
+    above for what the full-frame maps and operators take); entries bigger
+    than the budget are not cached, with a warning'''
+    dewarp_cache.maxBytes = maxBytes
+    dewarp_cache.evict()
+
+def _coefficient_hash(coeffs):
+    coeffs = np.ascontiguousarray(coeffs, dtype=np.float64)
+    return hashlib.sha1(np.array(coeffs.shape).tobytes()+coeffs.tobytes()).hexdigest()
+
+def _geometry_key(imshape,window):
+    window = None if window is None else tuple(int(w) for w in window)
+    if window == (0, 0):
+        window = None
+    return tuple(imshape), window
+
+def _read_only(array):
+    array.flags.writeable = False
+    return array
+
+def get_dewarp_coordinates(imshape,P,Q,window=None,dtype=np.float64,jacobian=False):
+    '''cached version of make_dewarp_coordinates, keyed by frame shape,
+    readout window, coefficients and dtype of the maps. A subarray map is
+    sliced out of the full-detector map if that has been computed already,
+    and otherwise only the subarray is evaluated. With jacobian=True the
+    Jacobian determinant map is returned (and cached) as well.
+    The maps returned are shared with later callers, so they are
+    read-only; copy them to change them.'''
+    imshape, window = _geometry_key(imshape,window)
+    _check_window(imshape,window)
+    coeffKey = (_coefficient_hash(P), _coefficient_hash(Q), np.dtype(dtype).str)
+    coords = dewarp_cache.get(('coords', imshape, window)+coeffKey)
+    jac = dewarp_cache.get(('jacobian', imshape, window)+coeffKey) if jacobian else None
+    if coords is not None and (jac is not None or not jacobian):
+        return (list(coords), jac) if jacobian else list(coords)
+
+    fullCoords = dewarp_cache.get(('coords', tuple(detector_shape), None)+coeffKey)
+    fullJac = dewarp_cache.get(('jacobian', tuple(detector_shape), None)+coeffKey) if jacobian else None
+    if window is not None and fullCoords is not None and (fullJac is not None or not jacobian):
+        y0, x0 = window
+        subarray = (slice(None), slice(y0,y0+imshape[0]), slice(None), slice(x0,x0+imshape[1]))
+        coords = [fullCoords[0][subarray]-y0, fullCoords[1][subarray]-x0]
+        jac = fullJac[subarray] if jacobian else None
+    elif jacobian:
+        coords, jac = make_dewarp_coordinates(imshape,P,Q,window,dtype,jacobian=True)
+    else:
+        coords = make_dewarp_coordinates(imshape,P,Q,window,dtype)
+    # the cached maps are handed out to every caller, so nobody may change them in place
+    # (each caller gets its own list, and the arrays are read-only)
+    coords = tuple(_read_only(np.asarray(coord, dtype=dtype)) for coord in coords)
+    dewarp_cache.put(('coords', imshape, window)+coeffKey, coords)
+    if jacobian:
+        jac = _read_only(jac)
+        dewarp_cache.put(('jacobian', imshape, window)+coeffKey, jac)
+        return list(coords), jac
+    return list(coords)
+
+def get_dewarp_operator(imshape,P,Q,window=None,kernel='bicubic'):
+    '''cached make_dewarp_operator for the coordinates from
+    get_dewarp_coordinates'''
+    imshape, window = _geometry_key(imshape,window)
+    key = ('operator', imshape, window, kernel, _coefficient_hash(P), _coefficient_hash(Q))
+    op = dewarp_cache.get(key)
+    if op is None:
+        op = make_dewarp_operator(imshape,get_dewarp_coordinates(imshape,P,Q,window),kernel)
+        dewarp_cache.put(key, op)
+    return op
 
 # function to make a sparse grid of sample points (i.e., non-consecutive integers)
 def make_dewarp_coordinates_sparseGrid(xGridArray,yGridArray,P,Q):
@@ -38,7 +247,488 @@ def make_dewarp_coordinates_sparseGrid(xGridArray,yGridArray,P,Q):
     yt=np.polynomial.polynomial.polygrid2d([yGridArray],[xGridArray],Q)
     return yt, xt
 
-def dewarp_with_precomputed_coords(image,coords,order=3):
+def test_float32_coords(P=None,Q=None,imshape=(2048,2048),tol=1e-3):
+    '''check that float32 coordinate maps stay within tol (pixels) of the
+    float64 ones across the frame; P, Q default to the LEECH solution
+    (distortion_solution.leech_Kx, leech_Ky). Returns the largest error.'''
+    if P is None or Q is None:
+        from astrom_lmircam_soln import distortion_solution # (it imports this module)
+        P, Q = np.array(distortion_solution.leech_Kx).T, np.array(distortion_solution.leech_Ky).T
+    coords64 = make_dewarp_coordinates(imshape,P,Q)
+    coords32 = make_dewarp_coordinates(imshape,P,Q,dtype=np.float32)
+    maxErr = max(np.abs(coords32[0]-coords64[0]).max(), np.abs(coords32[1]-coords64[1]).max())
+    assert maxErr < tol, 'float32 coordinates off by %.2e pix' % maxErr
+    return maxErr
+
+def dewarp_with_precomputed_coords(image,coords,order=3,kernel=None,backend='scipy',jacobian=None):
     '''use make_dewarp_coordinates to get coords, a list
-    of y-coordinates and x-coordinate arrays.'''
-    return map_coordinates(image,coords,order=order)
+    of y-coordinates and x-coordinate arrays.
+    kernel is as in dewarp; note the weight tables are rebuilt on every
+    call, so for many frames use make_dewarp_operator instead.
+    backend='numba' uses a compiled, multi-threaded bilinear (order 1) or
+    bicubic convolution (order 3, or kernel 'bicubic') gather in float32,
+    and returns float32; if numba isn't installed, this falls back to the
+    scipy path.
+    jacobian: the Jacobian determinant map from make_dewarp_coordinates;
+    if given, the output is scaled by it so that fluxes are preserved,
+    and is floating point (float32 for float32 or 16-bit integer frames).'''
+    if backend not in ('scipy', 'numba'):
+        raise ValueError("backend must be 'scipy' or 'numba'")
+    if backend == 'numba' and numba is not None:
+        if kernel is None:
+            kernel = {1: 'bilinear', 3: 'bicubic'}.get(order)
+        if kernel not in _numba_gathers:
+            raise ValueError("the numba backend does 'bilinear' or 'bicubic' only")
+        dewarped = _numba_gathers[kernel](np.ascontiguousarray(image, dtype=np.float32),
+                                          np.ascontiguousarray(np.ravel(coords[0]), dtype=np.float32),
+                                          np.ascontiguousarray(np.ravel(coords[1]), dtype=np.float32)
+                                          ).reshape(np.shape(coords[0]))
+    elif kernel is not None:
+        op, outshape = make_dewarp_operator(image.shape,coords,kernel)
+        dewarped = np.reshape(dewarp_with_operator(image,op,outshape),np.shape(coords[0]))
+    elif jacobian is not None: # interpolate integer frames into floats, before scaling
+        dewarped = map_coordinates(image,coords,order=order,output=_flux_dtype(np.asarray(image).dtype))
+    else:
+        dewarped = map_coordinates(image,coords,order=order)
+    if jacobian is not None:
+        dewarped = _scale_by_jacobian(dewarped,jacobian)
+    return dewarped
+
+def _flux_dtype(dtype):
+    # float type for flux-scaled output: float32 for float32 (or 16-bit integer) data
+    return np.result_type(dtype, np.float32)
+
+def _scale_by_jacobian(dewarped,jacobian):
+    # scale by |J| in floating point, and not in place, so that integer frames
+    # don't get |J| ~ 1 truncated to 0 or 1
+    fluxDtype = _flux_dtype(dewarped.dtype)
+    return dewarped.astype(fluxDtype, copy=False)*np.abs(jacobian).astype(fluxDtype, copy=False)
+
+
+# tiled dewarping, for bounded memory use: the coordinate map is evaluated, and
+# the image interpolated, one block of output rows at a time. Each block only
+# needs the input rows its coordinates fall on, plus a halo of extra rows so
+# that the spline prefilter of the block matches that of the full image
+
+def dewarp_tiled(image,P,Q,order=3,tileRows=128,halo=16,dtype=None,out=None):
+    '''same as dewarp, but peak memory is set by tileRows rather than by
+    the image size. image can also be an (N, H, W) cube, which is done a
+    frame at a time. Unlike dewarp, the output has the shape of the input
+    (no singleton dimensions), and is of type dtype (by default
+    frame_dtype, or float64 for float64 images).
+    INPUTS:
+    image: 2D array or 3D cube
+    P, Q: as in dewarp
+    tileRows: number of output rows done at a time
+    halo: number of extra input rows on each side of a tile
+    out: optional array of the shape of image to write the output into
+         (otherwise it is allocated once, for the whole cube)'''
+    image = np.asarray(image)
+    if dtype is None:
+        dtype = np.result_type(image.dtype, frame_dtype)
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype)
+    if image.ndim == 3:
+        for frameNum in range(image.shape[0]):
+            dewarp_tiled(image[frameNum],P,Q,order,tileRows,halo,dtype,out=out[frameNum])
+        return out
+    sh = image.shape
+    cols = np.arange(sh[1])
+    for firstRow in range(0, sh[0], tileRows):
+        rows = np.arange(firstRow, min(firstRow+tileRows, sh[0]))
+        xt = np.polynomial.polynomial.polygrid2d(rows,cols,P)
+        yt = np.polynomial.polynomial.polygrid2d(rows,cols,Q)
+        # input rows needed for this tile
+        lo = max(0, int(np.floor(yt.min()))-halo)
+        hi = min(sh[0], int(np.ceil(yt.max()))+halo+1)
+        if lo >= hi: # tile maps entirely off the frame
+            out[rows[0]:rows[-1]+1] = 0
+            continue
+        map_coordinates(image[lo:hi],[yt-lo,xt],order=order,output=out[rows[0]:rows[-1]+1])
+    return out
+
+# transforming point coordinates (e.g. star centroids) instead of resampling
+# images. In the convention used throughout this module, a position (x, y) in
+# the dewarped image maps to (xt, yt) = (F(y,x|P), F(y,x|Q)) in the raw image
+
+def warp_points(x,y,P,Q):
+    '''map positions x, y (arrays of any shape) in the dewarped frame
+    to where they are in the raw (warped) frame'''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    xt = np.polynomial.polynomial.polyval2d(y,x,P)
+    yt = np.polynomial.polynomial.polyval2d(y,x,Q)
+    return xt, yt
+
+def warp_jacobian(x,y,P,Q):
+    '''partial derivatives of warp_points at x, y, from the analytic
+    derivatives of the polynomials: returns dxt/dx, dxt/dy, dyt/dx, dyt/dy'''
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    polyval2d = np.polynomial.polynomial.polyval2d
+    polyder = np.polynomial.polynomial.polyder
+    return (polyval2d(y,x,polyder(P,axis=1)), polyval2d(y,x,polyder(P,axis=0)),
+            polyval2d(y,x,polyder(Q,axis=1)), polyval2d(y,x,polyder(Q,axis=0)))
+
+def dewarp_points(xRaw,yRaw,P,Q,tol=1e-8,maxIter=20):
+    '''inverse of warp_points: find the dewarped positions of points at
+    xRaw, yRaw in the raw frame (e.g. stars found on raw images), with
+    Newton iterations on all points at once. No refit of an inverse
+    polynomial is needed.'''
+    xRaw = np.asarray(xRaw, dtype=np.float64)
+    yRaw = np.asarray(yRaw, dtype=np.float64)
+    x, y = xRaw.copy(), yRaw.copy() # the distortion is small, so start from the raw positions
+    for iteration in range(maxIter):
+        xt, yt = warp_points(x,y,P,Q)
+        dxtdx, dxtdy, dytdx, dytdy = warp_jacobian(x,y,P,Q)
+        det = dxtdx*dytdy-dxtdy*dytdx
+        stepX = (dytdy*(xt-xRaw)-dxtdy*(yt-yRaw))/det
+        stepY = (dxtdx*(yt-yRaw)-dytdx*(xt-xRaw))/det
+        x -= stepX
+        y -= stepY
+        if np.all(np.abs(stepX) < tol) and np.all(np.abs(stepY) < tol):
+            break
+    return x, y
+
+# dewarping and derotating in one interpolation: the rotation by the parallactic
+# angle is folded into the coordinate map, so each frame is only resampled once
+
+def make_dewarp_derotate_coordinates(imshape,P,Q,pa,center=None,dtype=np.float64):
+    '''like make_dewarp_coordinates, but the output is also rotated by the
+    parallactic angle pa (degrees) about center ((y, x); default is the
+    middle of the frame), the same way as ROT(array, -pa) in IDL, i.e. the
+    image is turned counterclockwise by pa as displayed with the origin at
+    the lower left. Returns [yt, xt] of shape imshape.'''
+    if center is None:
+        center = ((imshape[0]-1)/2., (imshape[1]-1)/2.)
+    yc, xc = center
+    yy, xx = np.indices(imshape, dtype=np.float64)
+    cosPA, sinPA = np.cos(np.radians(pa)), np.sin(np.radians(pa))
+    # position in the dewarped (not yet derotated) frame
+    xd = xc+cosPA*(xx-xc)+sinPA*(yy-yc)
+    yd = yc-sinPA*(xx-xc)+cosPA*(yy-yc)
+    xt = np.polynomial.polynomial.polyval2d(yd,xd,P)
+    yt = np.polynomial.polynomial.polyval2d(yd,xd,Q)
+    return [yt.astype(dtype,copy=False), xt.astype(dtype,copy=False)]
+
+def dewarp_derotate(image,P,Q,pa,order=3,center=None):
+    '''dewarp and derotate an image in a single interpolation; P and Q
+    as in dewarp, pa and center as in make_dewarp_derotate_coordinates'''
+    return map_coordinates(image,make_dewarp_derotate_coordinates(image.shape,P,Q,pa,center),order=order)
+
+# precomputed sparse interpolation operators, for dewarping many frames with
+# the same coordinates: the interpolation weights are worked out once, and
+# each frame (or cube) is then a single sparse matrix product
+
+def _keys_cubic(t):
+    # Keys (1981) cubic convolution kernel, a=-0.5
+    t = np.abs(t)
+    return np.where(t <= 1., (1.5*t-2.5)*t*t+1.,
+                    np.where(t < 2., ((-0.5*t+2.5)*t-4.)*t+2., 0.))
+
+def _lanczos3(t):
+    return np.where(np.abs(t) < 3., np.sinc(t)*np.sinc(t/3.), 0.)
+
+# kernel name: (function, offsets of the taps relative to floor(coordinate))
+interpolation_kernels = {'nearest': (lambda t: ((t >= -0.5) & (t < 0.5)).astype(np.float64), range(0, 2)),
+                         'bilinear': (lambda t: np.clip(1.-np.abs(t), 0., None), range(0, 2)),
+                         'bicubic': (_keys_cubic, range(-1, 3)),
+                         'lanczos3': (_lanczos3, range(-2, 4))}
+
+def _kernel_taps(coord, length, kernel):
+    # 1D tap indices and weights for each coordinate; taps falling off the
+    # frame get zero weight (i.e. zero outside the frame)
+    kernelFcn, offsets = interpolation_kernels[kernel]
+    base = np.floor(coord)
+    taps = base[:, None]+np.array(offsets)[None, :]
+    weights = kernelFcn(coord[:, None]-taps)
+    weights /= weights.sum(axis=1)[:, None]
+    weights[(taps < 0) | (taps > length-1)] = 0.
+    return np.clip(taps, 0, length-1).astype(np.int64), weights
+
+def make_dewarp_operator(imshape,coords,kernel='bicubic',dtype=np.float32):
+    '''compile coords (as from make_dewarp_coordinates) into a sparse
+    matrix that maps a flattened input image of shape imshape onto the
+    flattened dewarped image, with fixed weights for each output pixel.
+    kernel is one of interpolation_kernels ('nearest', 'bilinear',
+    'bicubic' (Keys cubic convolution) or 'lanczos3'); note that these are not the same as
+    the spline interpolation of map_coordinates.
+    Returns the operator and the (squeezed) shape of the output image,
+    to be passed on to dewarp_with_operator.'''
+    yt, xt = coords
+    outshape = np.squeeze(yt).shape
+    yTaps, yWeights = _kernel_taps(np.ravel(yt).astype(np.float64), imshape[0], kernel)
+    xTaps, xWeights = _kernel_taps(np.ravel(xt).astype(np.float64), imshape[1], kernel)
+
+    # every output pixel gets the same number of taps (some with zero weight)
+    numPts, numTaps = yTaps.shape
+    indexDtype = np.int32 if imshape[0]*imshape[1] < 2**31 else np.int64
+    indices = (yTaps[:, :, None]*imshape[1]+xTaps[:, None, :]).astype(indexDtype)
+    weights = (yWeights[:, :, None]*xWeights[:, None, :]).astype(dtype)
+    indptr = np.arange(0, numPts*numTaps**2+1, numTaps**2, dtype=indexDtype)
+    op = sparse.csr_matrix((np.ravel(weights), np.ravel(indices), indptr),
+                           shape=(numPts, imshape[0]*imshape[1]))
+    return op, outshape
+
+def dewarp_with_operator(image,op,outshape):
+    '''dewarp a 2D image, or an (N, H, W) cube, with an operator from
+    make_dewarp_operator (or load_dewarp_operator)'''
+    image = np.asarray(image)
+    frames = np.reshape(image, (-1, op.shape[1]))
+    dewarped = op.dot(frames.T).T
+    return np.reshape(dewarped, image.shape[:-2]+tuple(outshape))
+
+def dewarp_masked(image,coords=None,badmask=None,kernel='bilinear',operator=None,minWeight=0.5):
+    '''dewarp an image (or (N, H, W) cube) that has bad pixels in it, and
+    the validity of its pixels along with it. NaNs and pixels flagged
+    nonzero in badmask (2D) get zero weight, the data and the valid-pixel
+    weights are both resampled (the weights only once, if they are the
+    same for every frame), and the data are renormalized by the
+    resampled weights. So nothing needs
+    fixing before dewarping, and fix_pix can be run afterwards, only on
+    the output pixels that are flagged.
+    INPUTS:
+    image: 2D array or 3D cube
+    coords: [yt, xt] from make_dewarp_coordinates (not needed if operator
+            is given)
+    badmask: 2D array, nonzero values are "bad"
+    kernel: as in make_dewarp_operator
+    operator: (op, outshape) from make_dewarp_operator, to reuse it
+    minWeight: output pixels with less than this fraction of valid
+               weight are set to NaN
+    RETURNS:
+    dewarped: the dewarped image (or cube), NaN where there isn't enough
+              valid data
+    weight: the resampled weight of the valid pixels (1 where all input
+            pixels were good, 0 where all were bad or off the frame);
+            if no frame has NaNs, this is one map for all the frames
+            (read-only, broadcast to the shape of dewarped)
+    The data are kept in frame_dtype (float32), or float64 if they come
+    as float64.'''
+    image = np.asarray(image)
+    workDtype = np.result_type(image.dtype, frame_dtype)
+    if operator is None:
+        operator = make_dewarp_operator(image.shape[-2:],coords,kernel)
+    op, outshape = operator
+    fullOutshape = image.shape[:-2]+tuple(outshape)
+    frames = np.reshape(image, (-1, op.shape[1]))
+    good = None if badmask is None else (np.ravel(badmask) == 0)
+    sharedWeight = None
+
+    # (the sum is only non-finite if some pixel is; this avoids a full-size boolean cube)
+    if not np.issubdtype(image.dtype, np.floating) or np.isfinite(np.sum(frames)):
+        # the same valid pixels in every frame: resample the weights once
+        if good is None:
+            weight = op.dot(np.ones(op.shape[1], dtype=workDtype))
+            total = op.dot(frames.astype(workDtype, copy=False).T).T
+        else:
+            weight = op.dot(good.astype(workDtype))
+            total = op.dot(np.where(good, frames, 0).astype(workDtype, copy=False).T).T
+        sharedWeight = weight
+        weight = np.broadcast_to(weight, total.shape)
+    else:
+        # NaNs differ from frame to frame, so the weights do too; go a frame at a time
+        total = np.zeros((frames.shape[0], op.shape[0]), dtype=workDtype)
+        weight = np.zeros((frames.shape[0], op.shape[0]), dtype=workDtype)
+        for frameNum in range(frames.shape[0]):
+            valid = np.isfinite(frames[frameNum])
+            if good is not None:
+                valid &= good
+            total[frameNum] = op.dot(np.where(valid, frames[frameNum], 0).astype(workDtype, copy=False))
+            weight[frameNum] = op.dot(valid.astype(workDtype))
+
+    dewarped = np.full(total.shape, np.nan, dtype=np.result_type(total.dtype, workDtype))
+    enough = weight >= minWeight
+    dewarped[enough] = total[enough]/weight[enough]
+    if sharedWeight is not None:
+        return np.reshape(dewarped, fullOutshape), np.broadcast_to(np.reshape(sharedWeight, outshape), fullOutshape)
+    return np.reshape(dewarped, fullOutshape), np.reshape(weight, fullOutshape)
+
+def save_dewarp_operator(fileName,op,outshape):
+    '''write an operator from make_dewarp_operator to an .npz file'''
+    np.savez(fileName, data=op.data, indices=op.indices, indptr=op.indptr,
+             shape=np.array(op.shape), outshape=np.array(outshape))
+
+def load_dewarp_operator(fileName):
+    '''read back an operator written by save_dewarp_operator;
+    returns the operator and the output shape'''
+    npz = np.load(fileName)
+    op = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']),
+                           shape=tuple(npz['shape']))
+    return op, tuple(npz['outshape'])
+
+
+# batch dewarping over a pool of workers. Nothing big is pickled to the workers:
+# threads are handed the coordinate maps, frames and output array directly; worker
+# processes memory-map the coordinate maps from a temporary .npy file, and
+# inherit array input from the parent (fork), sending back the dewarped frames.
+# The module globals below are only used by the worker processes
+
+_batch_coords = None
+_batch_frames = None
+
+def _init_batch_worker(coordsFile,frames=None):
+    # memory-map the coordinate maps; frames is None in forked workers,
+    # which already have them
+    global _batch_coords, _batch_frames
+    _batch_coords = np.load(coordsFile, mmap_mode='r')
+    if frames is not None:
+        _batch_frames = frames
+
+def _dewarp_batch_frame(args,coords,frames,output=None):
+    # dewarp one frame; written to a FITS file, or into output, or returned
+    frameNum, fileName, outFileName, order = args
+    if fileName is None:
+        image, header = frames[frameNum], None
+    else:
+        image, header = fits.getdata(fileName, 0, header=True)
+    # (interpolating straight into floats, so 16-bit frames aren't rounded)
+    dewarped = np.squeeze(map_coordinates(image, coords, order=order,
+                                          output=np.result_type(image.dtype, frame_dtype)))
+    if outFileName is not None:
+        fits.writeto(outFileName, dewarped, header, overwrite=True)
+    elif output is not None:
+        output[frameNum] = dewarped
+    else:
+        return dewarped
+
+def _dewarp_batch_worker(args):
+    return _dewarp_batch_frame(args, _batch_coords, _batch_frames)
+
+def _can_fork():
+    return hasattr(multiprocessing, 'get_context') and 'fork' in multiprocessing.get_all_start_methods()
+
+def dewarp_batch(frames,coords,order=3,outFileNames=None,processes=None,useThreads=False,tmpDir=None):
+    '''dewarp many frames with the same coordinates (from
+    make_dewarp_coordinates) across a pool of workers.
+    INPUTS:
+    frames: list of FITS file names, or an (N, H, W) array
+    coords: [yt, xt] from make_dewarp_coordinates
+    order: spline order, as in dewarp_with_precomputed_coords
+    outFileNames: (FITS input only) list of file names to write the dewarped
+                  frames to, with the input headers; if None the dewarped
+                  frames are returned as an (N, H, W) array (frame_dtype, or
+                  float64 for float64 frames)
+    processes: number of workers (default: number of cores)
+    useThreads: use a pool of threads instead of processes (no copies or
+                temporary files at all)
+    tmpDir: directory for the temporary file of coordinate maps that
+            worker processes memory-map (default: the system temp dir)'''
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    fromFiles = not isinstance(frames, np.ndarray)
+    numFrames = len(frames)
+    if outFileNames is not None and not fromFiles:
+        raise ValueError('outFileNames can only be used with FITS file input')
+    coords = np.asarray(coords) # stacked once, so map_coordinates doesn't do it for every frame
+
+    output = None
+    if outFileNames is None:
+        if fromFiles:
+            with fits.open(frames[0]) as hdul: # (scaled 16-bit data come as float32)
+                frameDtype = hdul[0].data.dtype
+        else:
+            frameDtype = frames.dtype
+        outDtype = np.result_type(frameDtype, frame_dtype)
+        output = np.zeros((numFrames,)+np.squeeze(coords[0]).shape, dtype=outDtype)
+
+    tasks = [(frameNum,
+              frames[frameNum] if fromFiles else None,
+              outFileNames[frameNum] if outFileNames is not None else None,
+              order) for frameNum in range(numFrames)]
+
+    if useThreads:
+        pool = ThreadPool(processes)
+        try:
+            pool.map(functools.partial(_dewarp_batch_frame, coords=coords,
+                                       frames=None if fromFiles else frames, output=output),
+                     tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return output
+
+    global _batch_frames
+    tmpDir = tempfile.mkdtemp(prefix='dewarp_batch_', dir=tmpDir)
+    try:
+        coordsFile = os.path.join(tmpDir, 'coords.npy')
+        np.save(coordsFile, coords)
+        if _can_fork():
+            # forked workers inherit the frames (copy-on-write) from here
+            _batch_frames = None if fromFiles else frames
+            pool = multiprocessing.get_context('fork').Pool(processes, _init_batch_worker, (coordsFile,))
+        else:
+            pool = multiprocessing.Pool(processes, _init_batch_worker,
+                                        (coordsFile, None if fromFiles else frames))
+        try:
+            for frameNum, dewarped in enumerate(pool.imap(_dewarp_batch_worker, tasks)):
+                if output is not None:
+                    output[frameNum] = dewarped
+        finally:
+            pool.close()
+            pool.join()
+            _batch_frames = None
+        return output
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+
+
+# optional numba backend for dewarp_with_precomputed_coords: a parallel gather
+# over the output pixels, with the same kernels (and zero outside the frame)
+# as make_dewarp_operator
+
+_numba_gathers = {}
+
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _gather_bilinear(image, yt, xt):
+        ny, nx = image.shape
+        dewarped = np.empty(yt.size, dtype=np.float32)
+        for k in numba.prange(yt.size):
+            y0 = int(np.floor(yt[k]))
+            x0 = int(np.floor(xt[k]))
+            fy = yt[k]-y0
+            fx = xt[k]-x0
+            total = 0.
+            for dy in range(2):
+                if y0+dy < 0 or y0+dy > ny-1:
+                    continue
+                wy = 1.-fy if dy == 0 else fy
+                for dx in range(2):
+                    if x0+dx < 0 or x0+dx > nx-1:
+                        continue
+                    wx = 1.-fx if dx == 0 else fx
+                    total += wy*wx*image[y0+dy, x0+dx]
+            dewarped[k] = total
+        return dewarped
+
+    @numba.njit(cache=True)
+    def _keys_cubic_weight(t):
+        t = abs(t)
+        if t <= 1.:
+            return (1.5*t-2.5)*t*t+1.
+        elif t < 2.:
+            return ((-0.5*t+2.5)*t-4.)*t+2.
+        return 0.
+
+    @numba.njit(parallel=True, cache=True)
+    def _gather_bicubic(image, yt, xt):
+        ny, nx = image.shape
+        dewarped = np.empty(yt.size, dtype=np.float32)
+        for k in numba.prange(yt.size):
+            y0 = int(np.floor(yt[k]))
+            x0 = int(np.floor(xt[k]))
+            total = 0.
+            for dy in range(-1, 3):
+                if y0+dy < 0 or y0+dy > ny-1:
+                    continue
+                wy = _keys_cubic_weight(yt[k]-(y0+dy))
+                for dx in range(-1, 3):
+                    if x0+dx < 0 or x0+dx > nx-1:
+                        continue
+                    total += wy*_keys_cubic_weight(xt[k]-(x0+dx))*image[y0+dy, x0+dx]
+            dewarped[k] = total
+        return dewarped
+
+    _numba_gathers['bilinear'] = _gather_bilinear
+    _numba_gathers['bicubic'] = _gather_bicubic
@@ -0,0 +1,152 @@
+# A distortion solution as one object: the forward coefficients Kx, Ky (dewarped -> raw) and the
+# inverse ones (raw -> dewarped), all in the convention of polywarp.polywarp, plus everything that
+# is derived from them (coordinate maps, Jacobian, sparse-grid maps, interpolation operators),
+# which is made the first time it is asked for and then reused.
+#
+# Coefficient convention: Kx[i,j] multiplies x^i*y^j, where (x,y) are dewarped coordinates,
+# and gives the raw x coordinate (likewise Ky gives raw y). This is what
+#     Kx, Ky = polywarp.polywarp(xFound, yFound, xIdeal, yIdeal, degree)
+# returns. The dewarp module wants the transposes, P = Kx.T and Q = Ky.T (the "coefficient
+# definition change btwn Python and IDL"); use the P and Q attributes instead of transposing by
+# hand. (polywarp_v2.applywarp takes Kx, Ky as they are.)
+
+import numpy as np
+from astrom_lmircam_soln import dewarp
+from astrom_lmircam_soln import polywarp
+from astrom_lmircam_soln import make_barb_plot
+
+# coefficients from the LEECH pipeline based on Maire+ 2015 measurements (epoch between July and Dec 2014)
+leech_Kx = [[-2.1478925,    0.0058138110,  -7.6396687e-06,   2.5359596e-09],
+            [1.0109149,  -2.3826537e-05,   2.8458629e-08,  -9.3206482e-12],
+            [-2.1164521e-05,   5.3115381e-08,  -6.6315643e-11,   2.2888432e-14],
+            [1.2983972e-08,  -4.1253977e-11,   5.1637044e-14,  -1.5988376e-17]]
+leech_Ky = [[9.2717864,      0.98776733,   4.3514612e-06,   9.3450739e-09],
+            [-0.013617797,  -3.9526096e-05,   8.1204222e-08,  -5.2048768e-11],
+            [1.1313247e-05,   6.7127301e-08,  -1.6531988e-10,   1.0656544e-13],
+            [1.6283111e-09,  -2.7723216e-11,   8.2118035e-14,  -5.3695050e-17]]
+
+class DistortionSolution(object):
+    '''Forward (dewarped -> raw) coefficients Kx, Ky and inverse (raw ->
+    dewarped) coefficients KxInv, KyInv, in the convention of
+    polywarp.polywarp (see the top of this file). If the inverse isn't
+    given, it is fit the first time it's needed, to the exact inverse
+    (dewarp.dewarp_points) on a grid over the detector with points
+    inverseGridSpacing pixels apart, as a polynomial of degree
+    inverseDegree (by default, that of the forward solution).
+
+    Full-frame coordinate maps, Jacobians and operators go through the
+    cache in the dewarp module (dewarp.get_dewarp_coordinates and
+    dewarp.get_dewarp_operator), so they are shared by everything using
+    the same coefficients; the rest is memoized on the object.'''
+
+    def __init__(self, Kx, Ky, KxInv=None, KyInv=None, description='', inverseGridSpacing=32., inverseDegree=None):
+        self.Kx = np.array(Kx, dtype=np.float64)
+        self.Ky = np.array(Ky, dtype=np.float64)
+        if (KxInv is None) != (KyInv is None):
+            raise ValueError('give both KxInv and KyInv, or neither')
+        self._inverse = None
+        if KxInv is not None:
+            self._inverse = (np.array(KxInv, dtype=np.float64), np.array(KyInv, dtype=np.float64))
+        self.description = description
+        self.inverseGridSpacing = inverseGridSpacing
+        self.inverseDegree = self.degree if inverseDegree is None else inverseDegree
+        self._memo = {}
+
+    @property
+    def degree(self):
+        return self.Kx.shape[0]-1
+
+    @property
+    def P(self):
+        # coefficients as the dewarp module wants them
+        return self.Kx.T
+
+    @property
+    def Q(self):
+        return self.Ky.T
+
+    def inverse(self):
+        '''inverse coefficients KxInv, KyInv (raw -> dewarped). Unless they
+        were given, they are fit (with polywarp.polywarp, of degree
+        inverseDegree) to the Newton inverse of the forward solution at raw
+        positions inverseGridSpacing pixels apart.
+        Being a polynomial itself, the inverse is only approximate (for the
+        LEECH solution, to about half a pixel in the middle of the frame
+        but many pixels off toward the corners); for exact positions use
+        dewarp_points.'''
+        if self._inverse is None:
+            xRaw, yRaw = np.meshgrid(np.arange(0., dewarp.detector_shape[1], self.inverseGridSpacing),
+                                     np.arange(0., dewarp.detector_shape[0], self.inverseGridSpacing))
+            xRaw, yRaw = np.ravel(xRaw), np.ravel(yRaw)
+            x, y = dewarp.dewarp_points(xRaw, yRaw, self.P, self.Q)
+            # leave out any points where the Newton iterations didn't converge (this can
+            # happen in the corners, where the forward polynomial is extrapolated)
+            xCheck, yCheck = dewarp.warp_points(x, y, self.P, self.Q)
+            converged = np.hypot(xCheck-xRaw, yCheck-yRaw) < 1e-3
+            self._inverse = polywarp.polywarp(x[converged], y[converged], xRaw[converged], yRaw[converged], degree=self.inverseDegree)
+        return self._inverse
+
+    def coordinates(self, imshape=dewarp.detector_shape, window=None, dtype=np.float64):
+        '''coordinate maps for dewarping, as from dewarp.make_dewarp_coordinates'''
+        return dewarp.get_dewarp_coordinates(imshape, self.P, self.Q, window=window, dtype=dtype)
+
+    def jacobian(self, imshape=dewarp.detector_shape, window=None, dtype=np.float64):
+        '''Jacobian determinant map (raw pixel area per dewarped pixel), for
+        the jacobian argument of dewarp.dewarp_with_precomputed_coords'''
+        return dewarp.get_dewarp_coordinates(imshape, self.P, self.Q, window=window, dtype=dtype, jacobian=True)[1]
+
+    def operator(self, imshape=dewarp.detector_shape, window=None, kernel='bicubic'):
+        '''sparse interpolation operator and output shape, as from dewarp.make_dewarp_operator'''
+        return dewarp.get_dewarp_operator(imshape, self.P, self.Q, window=window, kernel=kernel)
+
+    def sparse_grid_coordinates(self, xGridArray=None, yGridArray=None, inverse=False):
+        '''dewarp.make_dewarp_coordinates_sparseGrid on a grid of x and y
+        values (by default the grid of the barb plots,
+        make_barb_plot.barb_grid). With inverse=True the inverse
+        coefficients are used, i.e. the grid is taken as raw positions and
+        mapped to dewarped ones. Returns yt, xt, each (1, ny, 1, nx).'''
+        if xGridArray is None or yGridArray is None:
+            xGridArray, yGridArray = make_barb_plot.barb_grid()[2:4]
+        key = ('sparse', inverse, tuple(np.ravel(xGridArray)), tuple(np.ravel(yGridArray)))
+        if key not in self._memo:
+            if inverse:
+                KxInv, KyInv = self.inverse()
+                P, Q = KxInv.T, KyInv.T
+            else:
+                P, Q = self.P, self.Q
+            self._memo[key] = dewarp.make_dewarp_coordinates_sparseGrid(xGridArray, yGridArray, P, Q)
+        return self._memo[key]
+
+    def warp_points(self, x, y):
+        '''dewarped positions -> raw positions (dewarp.warp_points)'''
+        return dewarp.warp_points(x, y, self.P, self.Q)
+
+    def dewarp_points(self, xRaw, yRaw):
+        '''raw positions -> dewarped positions, exactly (dewarp.dewarp_points)'''
+        return dewarp.dewarp_points(xRaw, yRaw, self.P, self.Q)
+
+    def dewarp(self, image, order=3, window=None, dtype=np.float64):
+        '''dewarp a frame with the cached coordinate maps of its shape'''
+        coords = self.coordinates(np.shape(image)[-2:], window=window, dtype=dtype)
+        return dewarp.dewarp_with_precomputed_coords(image, coords, order=order)
+
+    def save(self, fileName):
+        '''write the coefficients (and the inverse, if it has been given or
+        fit) to an .npz file; the maps are not saved, as they are quick to
+        remake'''
+        arrays = {'Kx': self.Kx, 'Ky': self.Ky, 'description': np.array(self.description)}
+        if self._inverse is not None:
+            arrays['KxInv'], arrays['KyInv'] = self._inverse
+        np.savez(fileName, **arrays)
+
+def load_distortion_solution(fileName):
+    '''read back a DistortionSolution written by DistortionSolution.save'''
+    npz = np.load(fileName)
+    KxInv = npz['KxInv'] if 'KxInv' in npz.files else None
+    KyInv = npz['KyInv'] if 'KyInv' in npz.files else None
+    return DistortionSolution(npz['Kx'], npz['Ky'], KxInv, KyInv, description=str(npz['description']))
+
+def leech_solution():
+    '''the LEECH pipeline solution (Maire+ 2015), with the inverse fit on demand'''
+    return DistortionSolution(leech_Kx, leech_Ky,
+                              description='LEECH pipeline, based on Maire+ 2015 A&A 576 A133')
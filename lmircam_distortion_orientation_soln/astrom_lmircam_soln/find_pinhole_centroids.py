@@ -5,6 +5,7 @@
 
 import numpy as np
 import scipy
+from scipy.spatial import cKDTree
 from astropy.io import fits
 import matplotlib.pyplot as plt
 import photutils
@@ -37,32 +38,42 @@ def find_psf_centers(imagePass,fwhmPass,thresholdPass):
 
     return sources['xcentroid'], sources['ycentroid']
 
-def consistency_xy_found_guesses(xCoordsGuessesPass,yCoordsGuessesPass,xCoordsFoundPass,yCoordsFoundPass):
-    # makes each of the entries in the x,y lists of the guessed and found pinholes refer to the same pinholes
-    xCoordsGuesses_finalSortedPass = [] # initialize
-    yCoordsGuesses_finalSortedPass = []
-    xCoordsFound_finalSortedPass = []
-    yCoordsFound_finalSortedPass = []
+def match_mutual_nearest(xCoords1,yCoords1,xCoords2,yCoords2,maxDist=24.):
+    # pairs up two sets of points (e.g. guessed and found pinholes): point i of set 1 and point j of
+    # set 2 are a match if each is the other's nearest neighbor (from KD-tree queries) and they are
+    # less than maxDist pixels apart (the default is half the pinhole spacing); anything else
+    # is left unmatched, instead of being mispaired
+    # returns indices1, indices2 (matched pairs, in the order of set 1), and the indices of the
+    # unmatched points of each set, unmatched1, unmatched2
+    points1 = np.transpose([np.ravel(np.asarray(xCoords1, dtype=np.float64)), np.ravel(np.asarray(yCoords1, dtype=np.float64))])
+    points2 = np.transpose([np.ravel(np.asarray(xCoords2, dtype=np.float64)), np.ravel(np.asarray(yCoords2, dtype=np.float64))])
+    dist12, nearest12 = cKDTree(points2).query(points1, distance_upper_bound=maxDist)
+    dist21, nearest21 = cKDTree(points1).query(points2, distance_upper_bound=maxDist)
+    # (no neighbor within maxDist comes back as an index one past the end)
+    indices1 = np.where(np.isfinite(dist12))[0]
+    indices2 = nearest12[indices1]
+    mutual = (nearest21[indices2] == indices1)
+    indices1, indices2 = indices1[mutual], indices2[mutual]
+    unmatched1 = np.setdiff1d(np.arange(len(points1)), indices1)
+    unmatched2 = np.setdiff1d(np.arange(len(points2)), indices2)
+    return indices1, indices2, unmatched1, unmatched2
 
-    for p in range(0,32): # loop over stripes in the pinhole image
-        colSpacingPixels = 48
-        indicesStripeGuesses = np.where((xCoordsGuessesPass > p*colSpacingPixels) & (xCoordsGuessesPass < (p+1)*colSpacingPixels))
-        indicesStripeFound = np.where((xCoordsFoundPass > p*colSpacingPixels) & (xCoordsFoundPass < (p+1)*colSpacingPixels))
-        # make subset of points that are within the stripe
-        xCoordsGuessesSubset = xCoordsGuessesPass[indicesStripeGuesses]
-        yCoordsGuessesSubset = yCoordsGuessesPass[indicesStripeGuesses]
-        xCoordsFoundSubset = xCoordsFoundPass[indicesStripeFound]
-        yCoordsFoundSubset = yCoordsFoundPass[indicesStripeFound]
-        # sort subsets of points in y, and tack onto arrays
-        xCoordsGuessesSubset_sortedinY = (np.ravel(xCoordsGuessesSubset))[np.ravel(np.argsort(yCoordsGuessesSubset))]
-        yCoordsGuessesSubset_sortedinY = (np.ravel(yCoordsGuessesSubset))[np.ravel(np.argsort(yCoordsGuessesSubset))]
-        xCoordsFoundSubset_sortedinY = (np.ravel(xCoordsFoundSubset))[np.ravel(np.argsort(yCoordsFoundSubset))]
-        yCoordsFoundSubset_sortedinY = (np.ravel(yCoordsFoundSubset))[np.ravel(np.argsort(yCoordsFoundSubset))]
-        # concatenate
-        xCoordsGuesses_finalSortedPass = np.concatenate((xCoordsGuesses_finalSortedPass,xCoordsGuessesSubset_sortedinY))
-        yCoordsGuesses_finalSortedPass = np.concatenate((yCoordsGuesses_finalSortedPass,yCoordsGuessesSubset_sortedinY))
-        xCoordsFound_finalSortedPass = np.concatenate((xCoordsFound_finalSortedPass,xCoordsFoundSubset_sortedinY))
-        yCoordsFound_finalSortedPass = np.concatenate((yCoordsFound_finalSortedPass,yCoordsFoundSubset_sortedinY))
+def consistency_xy_found_guesses(xCoordsGuessesPass,yCoordsGuessesPass,xCoordsFoundPass,yCoordsFoundPass,maxDist=24.):
+    # makes each of the entries in the x,y lists of the guessed and found pinholes refer to the same pinholes;
+    # guesses and found pinholes that don't pair up within maxDist pixels (see match_mutual_nearest) are dropped
+    xCoordsGuessesPass = np.ravel(np.asarray(xCoordsGuessesPass)) # guesses come as np.matrix columns from put_down_grid_guesses
+    yCoordsGuessesPass = np.ravel(np.asarray(yCoordsGuessesPass))
+    xCoordsFoundPass = np.ravel(np.asarray(xCoordsFoundPass))
+    yCoordsFoundPass = np.ravel(np.asarray(yCoordsFoundPass))
 
-    return xCoordsGuesses_finalSortedPass, yCoordsGuesses_finalSortedPass,\
-        xCoordsFound_finalSortedPass,yCoordsFound_finalSortedPass
+    indicesGuesses, indicesFound, unmatchedGuesses, unmatchedFound = match_mutual_nearest(xCoordsGuessesPass,
+                                                                                          yCoordsGuessesPass,
+                                                                                          xCoordsFoundPass,
+                                                                                          yCoordsFoundPass,
+                                                                                          maxDist)
+    print('Matched %i pinholes; %i guesses and %i found pinholes left unmatched' % (len(indicesGuesses),
+                                                                                      len(unmatchedGuesses),
+                                                                                      len(unmatchedFound)))
+
+    return xCoordsGuessesPass[indicesGuesses], yCoordsGuessesPass[indicesGuesses],\
+        xCoordsFoundPass[indicesFound], yCoordsFoundPass[indicesFound]
@@ -1,6 +1,13 @@
+import os
+import shutil
+import hashlib
+import tempfile
 import numpy as np
+from scipy import sparse
+from scipy.ndimage import gaussian_filter
+from scipy.spatial import cKDTree
 
-def bfixpix(data, badmask, n=4, retdat=False):
+def bfixpix(data, badmask, n=4, retdat=False, method='kdtree'):
     """
     Taken from Ian Crossfields LPL website, modified for bug...
     
@@ -21,11 +28,19 @@ def bfixpix(data, badmask, n=4, retdat=False):
     _not_ modify input array `data`.  This is always True if a 1D
     array is input!
 
+    method : str
+    'kdtree' (default) finds the neighbors of all bad pixels at once
+    (see find_neighbor_shells); 'loop' is the original per-pixel
+    search. Both give the same answer. 'convolve' fills the bad pixels
+    by normalized convolution instead (see fixpix_normconv; n is not
+    used then), which costs the same however many pixels are bad.
+
     :RETURNS: 
     another numpy array (if retdat is True)
 
-    :TO_DO:
-    Implement new approach of Popowicz+2013 (http://arxiv.org/abs/1309.4224)
+    :NOTES:
+    A convolution-based approach in the spirit of Popowicz+2013
+    (http://arxiv.org/abs/1309.4224) is available as method='convolve'
     """
     # 2010-09-02 11:40 IJC: Created
     # 2012-04-05 14:12 IJMC: Added retdat option
@@ -46,9 +61,25 @@ def bfixpix(data, badmask, n=4, retdat=False):
     nbad = len(badx)
     print 'bfixpix: %i bad'%nbad
 
+    if nbad > 0 and nbad == np.size(badmask):
+        raise ValueError('badmask has no good pixels to take neighbors from')
+
     if retdat:
         data = np.array(data, copy=True)
 
+    if method == 'convolve':
+        fixed = fixpix_normconv(data, badmask, retdat=True)
+        data[badx, bady] = fixed[badx, bady]
+        return data if retdat else None
+    elif method == 'kdtree':
+        badx, bady, whichBad, neighborInd = find_neighbor_shells(badmask, n=n)
+        localSum = np.bincount(whichBad, weights=data.ravel()[neighborInd], minlength=nbad)
+        localDenominator = np.bincount(whichBad, minlength=nbad)
+        data[badx, bady] = 1.0 * localSum / localDenominator
+        return data if retdat else None
+    elif method != 'loop':
+        raise ValueError("method must be 'kdtree', 'loop' or 'convolve'")
+
     print 'looping over %i pixels'%nbad
     for ii in range(nbad):
         thisloc = badx[ii], bady[ii]
@@ -87,55 +118,296 @@ def bfixpix(data, badmask, n=4, retdat=False):
 
     return ret
 
+def fixpix_normconv(data, badmask, sigma=1., retdat=False):
+    """
+    Replace bad pixels by normalized convolution: smooth data*goodmask
+    and goodmask with the same Gaussian kernel and divide, so that each
+    bad pixel becomes a distance-weighted mean of the good pixels around
+    it. The Gaussian is applied as separable 1D filters, so the cost per
+    frame is fixed and does not depend on the number of bad pixels. Bad
+    pixels with no good pixel within reach of the kernel (big clusters,
+    bad columns) are filled in further passes with the kernel width
+    doubled each time.
+
+    :INPUTS:
+    data : numpy array, a (H, W) frame or an (N, H, W) cube
+
+    badmask : numpy array (H, W), nonzero values are "bad"
+
+    :OPTIONAL_INPUTS:
+    sigma : float
+    width (pixels) of the Gaussian kernel for the first pass
+
+    retdat : bool
+    If True, return an array instead of replacing-in-place
+
+    :RETURNS:
+    another numpy array (if retdat is True)
+    """
+    if retdat:
+        data = np.array(data, copy=True)
+    good = (np.asarray(badmask) == 0)
+    badx, bady = np.nonzero(~good)
+    if len(badx) == 0 or not good.any():
+        return data if retdat else None
+
+    # smooth over the two image axes only, if it's a cube
+    leadingAxes = (0,)*(np.ndim(data)-2)
+    # float32 frames (or raw integer frames) are smoothed in float32
+    workDtype = np.result_type(np.asarray(data).dtype, np.float32)
+    goodData = np.where(good, data, 0).astype(workDtype)
+    goodWeight = good.astype(workDtype)
+
+    unfilled = np.ones(len(badx), dtype=bool)
+    thisSigma = float(sigma)
+    while unfilled.any() and thisSigma < 2*max(good.shape):
+        num = gaussian_filter(goodData, leadingAxes+(thisSigma, thisSigma), mode='constant')
+        den = gaussian_filter(goodWeight, (thisSigma, thisSigma), mode='constant')
+        ind = np.where(unfilled & (den[badx, bady] > 1e-8))[0]
+        data[..., badx[ind], bady[ind]] = num[..., badx[ind], bady[ind]] / den[badx[ind], bady[ind]]
+        unfilled[ind] = False
+        thisSigma *= 2.
+
+    return data if retdat else None
+
+def find_neighbor_shells(badmask, n=4, maxChunkSize=2**22):
+    """
+    Vectorized version of the neighbor search done in bfixpix, for all
+    bad pixels in one pass.
+
+    bfixpix grows a square box around each bad pixel until it holds at
+    least n good pixels, and then averages the good pixels in the box that
+    lie on the n closest distinct distances. The half-width of that box is
+    the Chebyshev distance to the n-th nearest good pixel, which a KD-tree
+    over the good pixel coordinates gives directly; the distance shells are
+    then picked out of a table of box offsets sorted by distance, for all
+    bad pixels with the same box size at once.
+
+    :INPUTS:
+    badmask : numpy array (two-dimensional), nonzero values are "bad"
+
+    :OPTIONAL_INPUTS:
+    n : int
+    number of nearby, good pixels to average over
+
+    maxChunkSize : int
+    max number of (bad pixel, box offset) pairs held in memory at once
+
+    :RETURNS:
+    badx, bady : coordinates of the bad pixels, as from np.nonzero(badmask)
+
+    whichBad, neighborInd : arrays of equal length; entry k says that the
+    good pixel with flattened index neighborInd[k] is one of the pixels to
+    average for bad pixel number whichBad[k]
+    """
+    nx, ny = badmask.shape
+    good = (np.asarray(badmask) == 0)
+    badx, bady = np.nonzero(badmask)
+    nbad = len(badx)
+    goodx, goody = np.nonzero(good)
+
+    whichBad = [np.zeros(0, dtype=np.intp)]
+    neighborInd = [np.zeros(0, dtype=np.intp)]
+    if nbad == 0:
+        return badx, bady, whichBad[0], neighborInd[0]
+    if len(goodx) == 0:
+        raise ValueError('badmask has no good pixels to take neighbors from')
+
+    # box half-width for each bad pixel (if there are fewer than n good
+    # pixels in the whole frame, just take all of them)
+    tree = cKDTree(np.transpose([goodx, goody]))
+    chebDist = tree.query(np.transpose([badx, bady]), k=n, p=np.inf)[0]
+    chebDist = np.reshape(chebDist, (nbad, n))[:, -1]
+    rad = np.where(np.isfinite(chebDist), chebDist, max(nx, ny)).astype(int)
+
+    for thisRad in np.unique(rad):
+        # offsets within the box, sorted by distance
+        offsets = np.arange(-thisRad, thisRad+1)
+        dxx, dyy = np.meshgrid(offsets, offsets, indexing='ij')
+        dist2 = np.ravel(dxx**2 + dyy**2)
+        order = np.argsort(dist2, kind='mergesort')
+        dist2, dxx, dyy = dist2[order], np.ravel(dxx)[order], np.ravel(dyy)[order]
+
+        thisBad = np.where(rad == thisRad)[0]
+        chunk = max(1, maxChunkSize // len(dist2))
+        for start in range(0, len(thisBad), chunk):
+            ind = thisBad[start:start+chunk]
+            xx = badx[ind][:, None] + dxx[None, :]
+            yy = bady[ind][:, None] + dyy[None, :]
+            inFrame = (xx >= 0) & (xx < nx) & (yy >= 0) & (yy < ny)
+            isGood = inFrame & good[np.clip(xx, 0, nx-1), np.clip(yy, 0, ny-1)]
+
+            # squared distance of the n-th good pixel; everything good out
+            # to that distance is on one of the n closest shells
+            numGood = np.cumsum(isGood, axis=1)
+            nth = np.argmax(numGood >= min(n, len(goodx)), axis=1)
+            take = isGood & (dist2[None, :] <= dist2[nth][:, None])
+
+            rows, cols = np.nonzero(take)
+            whichBad.append(ind[rows])
+            neighborInd.append(xx[rows, cols]*ny + yy[rows, cols])
+
+    return badx, bady, np.concatenate(whichBad), np.concatenate(neighborInd)
+
 def find_neighbors(badmask, n=4, retdat=False):
     """
     The longest step in bfixpix is looping over the bad
     pixels to find the best neighbors for correction. If the 
     Pixel mask doesn't change, the good neighbors don't change either.
     Use this function to identify the neigbors. The output of this
-    function should be used as the input of fixpix_precomputed_neighbors
+    function should be used as the input of correct_with_precomputed_neighbors
+
+    The neighbors are returned as a tuple (badx, bady, weights), where
+    weights is a scipy.sparse CSR matrix with one row per bad pixel and
+    one column per (flattened) pixel of the frame, holding the averaging
+    weights bfixpix would use.
     """
     nx, ny = badmask.shape
-    badx, bady = np.nonzero(badmask)
+    badx, bady, whichBad, neighborInd = find_neighbor_shells(badmask, n=n)
     nbad = len(badx)
     print 'bfixpix: %i bad'%nbad
 
-    print 'looping over %i pixels'%nbad
-    bad_and_neighbors=[]
-    for ii in range(nbad):
-        thisloc = badx[ii], bady[ii]
-        rad = 0
-        numNearbyGoodPixels = 0
+    numNeighbors = np.bincount(whichBad, minlength=nbad)
+    weights = sparse.csr_matrix((1./numNeighbors[whichBad], (whichBad, neighborInd)),
+                                shape=(nbad, nx*ny))
+    return badx, bady, weights
 
-        while numNearbyGoodPixels<n:
-            rad += 1
-            xmin = max(0, badx[ii]-rad)
-            xmax = min(nx, badx[ii]+rad)
-            ymin = max(0, bady[ii]-rad)
-            ymax = min(ny, bady[ii]+rad)
-            x = np.arange(nx)[xmin:xmax+1]
-            y = np.arange(ny)[ymin:ymax+1]
-            yy,xx = np.meshgrid(y,x)
-            #print ii, rad, xmin, xmax, ymin, ymax, badmask.shape
+# default place to keep neighbor tables between runs, and its size limit
+neighbor_cache_dir = os.path.join(os.path.expanduser('~'), '.astrom_lmircam_soln', 'neighbor_cache')
+neighbor_cache_max_bytes = 2*1024**3
 
-            rr = abs((xx-badx[ii]) + 1j*(yy-bady[ii])) * (1. - badmask[xmin:xmax+1,ymin:ymax+1])#BUG in Ian's code? fixed
-            numNearbyGoodPixels = (rr>0).sum()
+def _neighbor_cache_key(badmask, n):
+    # hash of which pixels are bad (not of the mask dtype), the frame shape and n
+    mask = np.ascontiguousarray(np.asarray(badmask) != 0)
+    h = hashlib.sha1()
+    h.update(np.array(mask.shape, dtype=np.int64).tobytes())
+    h.update(np.packbits(mask).tobytes())
+    h.update(('n=%i'%n).encode('ascii'))
+    return h.hexdigest()
 
-        closestDistances = np.unique(np.sort(rr[rr>0])[0:n])
-        numDistances = len(closestDistances)
-        pixToTake=[]
-        for jj in range(numDistances):
-            pixToTake.append(rr==closestDistances[jj])
+def _evict_neighbor_cache(cache_dir, max_bytes):
+    # drop least recently used entries until the cache fits in max_bytes
+    entries = []
+    for name in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, name)
+        if not os.path.isdir(entry) or name.startswith('tmp'):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        except OSError: # removed by another process in the meantime
+            continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+def find_neighbors_cached(badmask, n=4, cache_dir=None, max_cache_bytes=None):
+    """
+    Same as find_neighbors, but keeps the result on disk so that it is only
+    ever computed once per bad-pixel mask. Entries are keyed by a hash of
+    the mask and n, stored as plain .npy files that are memory-mapped on
+    reading (so later runs, and other worker processes, get them back in
+    milliseconds), and evicted least-recently-used first once the cache
+    grows past max_cache_bytes.
+
+    :OPTIONAL_INPUTS:
+    cache_dir : str
+    directory for the cache (default: neighbor_cache_dir)
+
+    max_cache_bytes : int
+    size limit of the cache (default: neighbor_cache_max_bytes)
+    """
+    if cache_dir is None:
+        cache_dir = neighbor_cache_dir
+    if max_cache_bytes is None:
+        max_cache_bytes = neighbor_cache_max_bytes
+    entry = os.path.join(cache_dir, _neighbor_cache_key(badmask, n))
+    names = ['badx', 'bady', 'data', 'indices', 'indptr', 'shape']
+
+    if os.path.isdir(entry):
+        try:
+            arrays = dict((name, np.load(os.path.join(entry, name+'.npy'), mmap_mode='r'))
+                          for name in names)
+            os.utime(entry, None) # mark as recently used
+            weights = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                        shape=tuple(arrays['shape']))
+            return arrays['badx'], arrays['bady'], weights
+        except (IOError, OSError, ValueError): # evicted while reading, or damaged
+            pass
+
+    badx, bady, weights = find_neighbors(badmask, n=n)
 
-        bad_and_neighbors.append((badx[ii],bady[ii],xmin,xmax,ymin,ymax,np.any(pixToTake,axis=0)))
-    return bad_and_neighbors
+    # write to a temporary directory and rename it into place, so that a
+    # crash or a concurrent writer never leaves a half-written entry
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError: # made by another process
+            pass
+    tmpDir = tempfile.mkdtemp(prefix='tmp', dir=cache_dir)
+    arrays = {'badx': badx, 'bady': bady, 'data': weights.data, 'indices': weights.indices,
+              'indptr': weights.indptr, 'shape': np.array(weights.shape)}
+    for name in names:
+        np.save(os.path.join(tmpDir, name+'.npy'), arrays[name])
+    try:
+        os.rename(tmpDir, entry)
+    except OSError: # another process got there first
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    _evict_neighbor_cache(cache_dir, max_cache_bytes)
+
+    return badx, bady, weights
 
 def correct_with_precomputed_neighbors(data,bad_and_neighbors):
     '''use this function to fix bad pixels in an image, after
-    using fixpix_find_neighbors on the bad pixel mask to
+    using find_neighbors on the bad pixel mask to
     identify good neighbors. If fixing pixels in 5000 images with
     the same bad pixel mask, this function saves tons of time because 
-    the neighbors only have to be found once.'''
-    for badx, bady, xmin, xmax, ymin, ymax, take in bad_and_neighbors:
-        mean_good=1.*data[xmin:xmax+1,ymin:ymax+1][take].sum()/take.sum()
-        data[badx,bady]=mean_good
+    the neighbors only have to be found once.
+
+    data can be a single (H, W) frame or an (N, H, W) cube, which is
+    corrected in place with one sparse matrix product. Returns data.
+    (Neighbor lists made by older versions of find_neighbors are still
+    accepted, for single frames.)'''
+    if isinstance(bad_and_neighbors, list):
+        for badx, bady, xmin, xmax, ymin, ymax, take in bad_and_neighbors:
+            mean_good=1.*data[xmin:xmax+1,ymin:ymax+1][take].sum()/take.sum()
+            data[badx,bady]=mean_good
+        return data
+
+    badx, bady, weights = bad_and_neighbors
+    if len(badx) == 0:
+        return data
+    # only the neighbor pixels are read (and summed in float64), so float32
+    # cubes are never copied to float64 as a whole
+    frames = np.reshape(data, (-1, weights.shape[1]))
+    neighborInd = np.unique(weights.indices)
+    neighbors = np.asarray(frames[:, neighborInd], dtype=np.float64)
+    mean_good = weights[:, neighborInd].dot(neighbors.T).T
+    data[..., badx, bady] = np.reshape(mean_good, data.shape[:-2]+(len(badx),))
+    return data
+
+def test_bfixpix_methods(shape=(64,64), fraction=0.05, n=4, seed=None):
+    """
+    Check that method='kdtree' and method='loop' of bfixpix give the
+    same answer, on a random frame with a random bad-pixel mask that
+    also has bad pixels along the edges and in the corners, a cluster
+    of bad pixels, and a bad column. Returns the largest difference.
+    """
+    randomState = np.random.RandomState(seed)
+    nx, ny = shape
+    data = randomState.normal(size=shape)
+    badmask = (randomState.uniform(size=shape) < fraction).astype(int)
+    badmask[0, ::3] = 1 # edges and corners
+    badmask[::5, -1] = 1
+    badmask[-1, -2:] = 1
+    badmask[nx//3:nx//3+6, ny//2:ny//2+6] = 1 # cluster
+    badmask[:, ny//4] = 1 # bad column
+
+    fixedKdtree = bfixpix(data, badmask, n=n, retdat=True, method='kdtree')
+    fixedLoop = bfixpix(data, badmask, n=n, retdat=True, method='loop')
+    maxDiff = np.abs(fixedKdtree - fixedLoop).max()
+    assert maxDiff < 1e-12, 'kdtree and loop methods differ by %.2e' % maxDiff
+    return maxDiff
@@ -0,0 +1,121 @@
+# This makes a bad-pixel mask from stacks of dark and flat frames, streaming through them one
+# frame at a time so that memory use does not depend on the number of frames. The output can go
+# straight into fix_pix.bfixpix or fix_pix.find_neighbors.
+
+import numpy as np
+from astropy.io import fits
+
+# bit values in the output mask (any nonzero pixel is "bad" to fix_pix)
+HOT = 1
+COLD = 2
+VARIABLE = 4
+
+def robust_sigma(arrayPass):
+    # standard deviation estimated from the median absolute deviation
+    arrayPass = np.asarray(arrayPass)
+    return 1.4826*np.median(np.abs(arrayPass-np.median(arrayPass)))
+
+class RunningPixelStats(object):
+    '''Running per-pixel statistics over a sequence of frames: mean and
+    variance (Welford's algorithm, float64 accumulators), and counters of
+    how many frames each pixel was more than nsig (robust) sigma above or
+    below that frame's median. Only a few full-frame arrays are kept,
+    however many frames are added.'''
+
+    def __init__(self, shape, nsig=5.):
+        self.nsig = nsig
+        self.numFrames = 0
+        self.mean = np.zeros(shape, dtype=np.float64)
+        self.m2 = np.zeros(shape, dtype=np.float64)
+        self.highCount = np.zeros(shape, dtype=np.int32)
+        self.lowCount = np.zeros(shape, dtype=np.int32)
+
+    def add(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        self.numFrames += 1
+        delta = frame-self.mean
+        self.mean += delta/self.numFrames
+        self.m2 += delta*(frame-self.mean)
+
+        frameMedian = np.median(frame)
+        frameSigma = robust_sigma(frame)
+        self.highCount += (frame > frameMedian+self.nsig*frameSigma)
+        self.lowCount += (frame < frameMedian-self.nsig*frameSigma)
+
+    @property
+    def variance(self):
+        if self.numFrames < 2:
+            return np.zeros_like(self.m2)
+        return self.m2/(self.numFrames-1)
+
+def iter_frames(fileNames, ext=0):
+    # yields 2D frames one at a time from a list of FITS files, each of which
+    # may hold a single frame or a cube; cube slices are read (and scaled) one
+    # at a time through .section, because .data can't be memory-mapped for
+    # scaled (BZERO/BSCALE) data, as raw 16-bit frames are, and would read in
+    # the whole cube (without memmap, .section seeks to each slice in the file)
+    for fileName in fileNames:
+        with fits.open(fileName, memmap=False) as hdul:
+            hdu = hdul[ext]
+            if len(hdu.shape) == 2:
+                yield np.array(hdu.data, dtype=np.float64)
+            else:
+                for sliceNum in range(hdu.shape[0]):
+                    yield np.array(hdu.section[sliceNum], dtype=np.float64)
+
+def accumulate_stats(frames, nsig=5.):
+    # runs RunningPixelStats over an iterable of frames (e.g. iter_frames)
+    stats = None
+    for frame in frames:
+        if stats is None:
+            stats = RunningPixelStats(np.shape(frame), nsig=nsig)
+        stats.add(frame)
+    if stats is None:
+        raise ValueError('no frames to accumulate')
+    return stats
+
+def make_badpix_mask(darkFiles, flatFiles=None, nsig=5., flagFraction=0.5, coldFraction=0.5, ext=0):
+    '''
+    Make a bad-pixel mask from FITS dark frames and (optionally) flat frames.
+
+    INPUTS:
+    darkFiles: list of FITS file names of darks (frames or cubes)
+    flatFiles: list of FITS file names of flats (frames or cubes)
+    nsig: threshold (in robust sigmas) for calling a pixel an outlier
+    flagFraction: a pixel that is an outlier in more than this fraction
+                  of the frames is flagged
+    coldFraction: a pixel whose mean flat response, normalized to the
+                  median, is below this is flagged as cold
+    ext: FITS extension holding the data
+
+    RETURNS:
+    mask: uint8 array, 0 for good pixels, otherwise a sum of HOT, COLD and
+          VARIABLE for the reasons the pixel was flagged
+    '''
+    darkStats = accumulate_stats(iter_frames(darkFiles, ext=ext), nsig=nsig)
+    mask = np.zeros(darkStats.mean.shape, dtype=np.uint8)
+
+    # hot: high mean dark, or high in most individual darks
+    darkMean = darkStats.mean
+    hot = ((darkMean > np.median(darkMean)+nsig*robust_sigma(darkMean)) |
+           (darkStats.highCount > flagFraction*darkStats.numFrames))
+    mask[hot] |= HOT
+
+    # variable: much noisier than the typical pixel over the dark sequence
+    if darkStats.numFrames > 1:
+        darkSigma = np.sqrt(darkStats.variance)
+        variable = darkSigma > np.median(darkSigma)+nsig*robust_sigma(darkSigma)
+        mask[variable] |= VARIABLE
+
+    # cold: low response in the flats
+    if flatFiles:
+        flatStats = accumulate_stats(iter_frames(flatFiles, ext=ext), nsig=nsig)
+        flatResponse = flatStats.mean/np.median(flatStats.mean)
+        cold = ((flatResponse < coldFraction) |
+                (flatStats.lowCount > flagFraction*flatStats.numFrames))
+        mask[cold] |= COLD
+
+    print('Flagged %i hot, %i cold, %i variable pixels' % (np.sum((mask & HOT) > 0),
+                                                           np.sum((mask & COLD) > 0),
+                                                           np.sum((mask & VARIABLE) > 0)))
+    return mask
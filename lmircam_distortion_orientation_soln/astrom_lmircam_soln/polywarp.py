@@ -9,14 +9,82 @@ Shamelessly copied, well tested against IDL procedure
 import sys
 import numpy as np
 from scipy.optimize import curve_fit
+from scipy.special import comb
+from scipy.linalg import solve_triangular
 
-def polywarp(xi,yi,xo,yo,degree=1):
+def polywarp_design_matrix(xo,yo,degree):
+    """
+    Design (Vandermonde) matrix of the fit: one row per point, and column
+    i*(degree+1)+j holding xo^i * yo^j, i.e. in the order of kx.ravel()
+    """
+    vx = np.polynomial.polynomial.polyvander(np.asarray(xo, dtype=np.float64), degree)
+    vy = np.polynomial.polynomial.polyvander(np.asarray(yo, dtype=np.float64), degree)
+    return (vx[:,:,None]*vy[:,None,:]).reshape(len(vx), -1)
+
+def coordinate_scaling(coords):
+    """
+    Center and half-width of a set of coordinates, for mapping them onto
+    [-1,1] before fitting (which keeps high-degree fits well-conditioned)
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    center = 0.5*(coords.max()+coords.min())
+    halfWidth = 0.5*(coords.max()-coords.min())
+    return center, (halfWidth if halfWidth > 0 else 1.)
+
+def unscale_coeffs(coeffs,xScaling,yScaling):
+    """
+    Convert coefficients c[i,j] of a polynomial in the scaled coordinates
+    (xo-xCenter)/xHalfWidth, (yo-yCenter)/yHalfWidth into the coefficients
+    of the same polynomial in xo, yo
+    """
+    degree = np.shape(coeffs)[-1]-1
+    transforms = []
+    for center, halfWidth in (xScaling, yScaling):
+        # row i: coefficients of ((u-center)/halfWidth)^i as a polynomial in u
+        transform = np.zeros((degree+1, degree+1))
+        for i in range(degree+1):
+            for k in range(i+1):
+                transform[i,k] = comb(i, k)*(-center)**(i-k)/halfWidth**i
+        transforms.append(transform)
+    return np.dot(np.dot(transforms[0].T, coeffs), transforms[1])
+
+def scaled_problem(xi,yi,xo,yo,degree):
+    """
+    Set up a polywarp fit: the design matrix in the scaled coordinates
+    (see coordinate_scaling), the (len(xo), 2) targets [xi, yi], and the
+    scalings to pass on to unscale_solution.
+    Returns uu, x, xScaling, yScaling
+    """
+    xo = np.ravel(np.asarray(xo, dtype=np.float64))
+    yo = np.ravel(np.asarray(yo, dtype=np.float64))
+    x = np.transpose([np.ravel(xi), np.ravel(yi)]).astype(np.float64)
+    xScaling = coordinate_scaling(xo)
+    yScaling = coordinate_scaling(yo)
+    uu = polywarp_design_matrix((xo-xScaling[0])/xScaling[1], (yo-yScaling[0])/yScaling[1], degree)
+    return uu, x, xScaling, yScaling
+
+def unscale_solution(kk,xScaling,yScaling):
+    """
+    kx, ky from a (numTerms, 2) solution for the scaled design matrix of
+    scaled_problem
+    """
+    degree = int(round(np.sqrt(np.shape(kk)[0])))-1
+    kx = unscale_coeffs(kk[:,0].reshape(degree+1,degree+1), xScaling, yScaling)
+    ky = unscale_coeffs(kk[:,1].reshape(degree+1,degree+1), xScaling, yScaling)
+    return kx, ky
+
+def polywarp(xi,yi,xo,yo,degree=1,weights=None):
     """
     Fit a function of the form
     xi[k] = sum over i and j from 0 to degree of: kx[i,j] * xo[k]^i * yo[k]^j
     yi[k] = sum over i and j from 0 to degree of: ky[i,j] * xo[k]^i * yo[k]^j
     Return kx, ky
     len(xo) must be greater than or equal to (degree+1)^2
+
+    Kx and Ky are solved together by (SVD-based) least squares on
+    coordinates scaled to [-1,1], rather than with the normal equations,
+    which stays stable for high degrees and large numbers of points.
+    weights: optional per-point weights (e.g. inverse variances)
     """
     if len(xo) != len(yo) or len(xo) != len(xi) or len(xo) != len(yi):
         print("Error: length of xo, yo, xi, and yi must be the same")
@@ -24,27 +92,143 @@ def polywarp(xi,yi,xo,yo,degree=1):
     if len(xo) < (degree+1.)**2.:
         print("Error: length of arrays must be greater than (degree+1)^2")
         return
-    # ensure numpy arrays
-    xo = np.array(xo)
-    yo = np.array(yo)
-    xi = np.array(xi)
-    yi = np.array(yi)
-    # set up some useful variables
-    degree2 = (degree+1)**2
-    x = np.array([xi,yi])
-    u = np.array([xo,yo])
-    ut = np.zeros([degree2,len(xo)])
-    u2i = np.zeros(degree+1)
-    for i in range(len(xo)):
-        u2i[0] = 1.
-        zz = u[1,i]
-        for j in range(1,degree+1):
-            u2i[j]=u2i[j-1]*zz
-        ut[0:degree+1,i] = u2i
-        for j in range(1,degree+1):
-            ut[j*(degree+1):j*(degree+1)+degree+1,i]=u2i*u[0,i]**j
-    uu = ut.T
-    kk = np.dot(np.linalg.inv(np.dot(ut,uu).T).T,ut)
-    kx = np.dot(kk,x[0,:].T).reshape(degree+1,degree+1)
-    ky = np.dot(kk,x[1,:].T).reshape(degree+1,degree+1)
-    return kx,ky
+    # fit in scaled coordinates
+    uu, x, xScaling, yScaling = scaled_problem(xi,yi,xo,yo,degree)
+    if weights is not None:
+        sqrtWeights = np.sqrt(np.ravel(weights))[:,None]
+        uu = uu*sqrtWeights
+        x = x*sqrtWeights
+    kk = np.linalg.lstsq(uu, x, rcond=-1)[0]
+    return unscale_solution(kk, xScaling, yScaling)
+
+def select_polywarp_degree(xi,yi,xo,yo,degrees=range(1,8),numFolds=5,seed=None):
+    """
+    Pick the polywarp degree by k-fold cross-validation. The columns of the
+    design matrix for the highest degree are ordered so that those of every
+    lower degree come first; one QR factorization per fold then gives the
+    fits of all degrees, from the leading blocks of R and Q^T x, instead of
+    rebuilding the problem for each degree.
+    Returns bestDegree, cvResiduals (rms held-out residual in pixels, for
+    each of degrees) and kx, ky fitted to all points at bestDegree
+    """
+    degrees = list(degrees)
+    maxDegree = max(degrees)
+    uu, x = scaled_problem(xi,yi,xo,yo,maxDegree)[0:2]
+    numPoints = len(x)
+
+    # nested column order: all terms of degree <= d come before any higher ones
+    ii, jj = np.divmod(np.arange((maxDegree+1)**2), maxDegree+1)
+    nestedOrder = np.lexsort((jj, ii, np.maximum(ii, jj)))
+    uu = uu[:, nestedOrder]
+
+    folds = np.array_split(np.random.RandomState(seed).permutation(numPoints), numFolds)
+    sumSquares = np.zeros(len(degrees))
+    for fold in folds:
+        train = np.ones(numPoints, dtype=bool)
+        train[fold] = False
+        qq, rr = np.linalg.qr(uu[train])
+        qtx = np.dot(qq.T, x[train])
+        for k, degree in enumerate(degrees):
+            numTerms = (degree+1)**2
+            if numTerms > train.sum():
+                sumSquares[k] = np.inf
+                continue
+            kk = solve_triangular(rr[:numTerms,:numTerms], qtx[:numTerms])
+            sumSquares[k] += np.sum((x[fold]-np.dot(uu[fold][:,:numTerms], kk))**2)
+    cvResiduals = np.sqrt(sumSquares/numPoints)
+
+    bestDegree = degrees[int(np.argmin(cvResiduals))]
+    kx, ky = polywarp(xi,yi,xo,yo,degree=bestDegree)
+    return bestDegree, cvResiduals, kx, ky
+
+def polywarp_robust(xi,yi,xo,yo,degree=1,method='tukey',rejectSigma=3.,maxIter=30,tol=1e-10):
+    """
+    Robust version of polywarp, for matched points that include false
+    detections or mispaired points: iteratively reweighted least squares
+    on the distance between the fitted and the measured (xi, yi), with
+    method one of
+    'huber': weights fall off as 1/residual beyond 1.345 sigma
+    'tukey': biweight, weights go to zero beyond 4.685 sigma (the first
+             few iterations use Huber weights, to get a safe start)
+    'sigmaclip': points beyond rejectSigma sigma get zero weight
+    where sigma is re-estimated robustly (from the median residual) at
+    every iteration. Each iteration is a weighted least-squares solve on
+    the scaled coordinates, as in polywarp (not the normal equations).
+    Returns kx, ky and the inlier mask (residual below rejectSigma sigma)
+    """
+    if len(xo) < (degree+1.)**2.:
+        print("Error: length of arrays must be greater than (degree+1)^2")
+        return
+    uu, x, xScaling, yScaling = scaled_problem(xi,yi,xo,yo,degree)
+    numPoints = uu.shape[0]
+
+    weights = np.ones(numPoints)
+    kk = None
+    for iteration in range(maxIter):
+        kkOld = kk
+        sqrtWeights = np.sqrt(weights)[:,None]
+        kk = np.linalg.lstsq(uu*sqrtWeights, x*sqrtWeights, rcond=-1)[0]
+        residual = np.sqrt(np.sum((x-np.dot(uu, kk))**2, axis=1))
+        # per-axis sigma; the median of a 2D Gaussian's radial residual is 1.1774 sigma
+        sigma = max(np.median(residual)/1.1774, 1e-12)
+        scaled = residual/sigma
+        if method == 'huber' or (method == 'tukey' and iteration < 3):
+            weights = np.minimum(1., 1.345/np.maximum(scaled, 1e-12))
+        elif method == 'tukey':
+            weights = np.where(scaled < 4.685, (1.-(scaled/4.685)**2)**2, 0.)
+        elif method == 'sigmaclip':
+            weights = (scaled < rejectSigma).astype(np.float64)
+        else:
+            raise ValueError("method must be 'huber', 'tukey' or 'sigmaclip'")
+        if kkOld is not None and np.max(np.abs(kk-kkOld)) < tol and (method != 'tukey' or iteration >= 3):
+            break
+
+    inliers = residual < rejectSigma*sigma
+    kx, ky = unscale_solution(kk, xScaling, yScaling)
+    return kx,ky,inliers
+
+class PolywarpAccumulator(object):
+    """
+    Streaming version of polywarp, for fitting on many sets of matched
+    points (e.g. one per pinhole exposure or dither) without holding them
+    all in memory: add() each set as it comes, which updates the running
+    normal-equation sums U^T W U and U^T W x, and solve() at any point.
+
+    The coordinate scaling has to be fixed up front, since not all points
+    are seen at once; the default maps the LMIRCam detector onto [-1,1].
+    """
+    def __init__(self,degree=3,xScaling=(1023.5,1023.5),yScaling=(1023.5,1023.5)):
+        self.degree = degree
+        self.xScaling = xScaling
+        self.yScaling = yScaling
+        numTerms = (degree+1)**2
+        self.utu = np.zeros((numTerms,numTerms))
+        self.utx = np.zeros((numTerms,2))
+        self.numPoints = 0
+
+    def add(self,xi,yi,xo,yo,weights=None):
+        xo = np.ravel(np.asarray(xo, dtype=np.float64))
+        yo = np.ravel(np.asarray(yo, dtype=np.float64))
+        x = np.transpose([np.ravel(xi), np.ravel(yi)]).astype(np.float64)
+        uu = polywarp_design_matrix((xo-self.xScaling[0])/self.xScaling[1],
+                                    (yo-self.yScaling[0])/self.yScaling[1], self.degree)
+        uw = uu if weights is None else uu*np.ravel(weights)[:,None]
+        self.utu += np.dot(uw.T, uu)
+        self.utx += np.dot(uw.T, x)
+        self.numPoints += len(xo)
+
+    def merge(self,other):
+        # fold in another accumulator (e.g. one filled by another process)
+        if (other.degree, other.xScaling, other.yScaling) != (self.degree, self.xScaling, self.yScaling):
+            raise ValueError("accumulators must have the same degree and scaling")
+        self.utu += other.utu
+        self.utx += other.utx
+        self.numPoints += other.numPoints
+
+    def solve(self):
+        # returns kx, ky as from polywarp
+        if self.numPoints < (self.degree+1)**2:
+            print("Error: number of points must be greater than (degree+1)^2")
+            return
+        kk = np.linalg.solve(self.utu, self.utx)
+        return unscale_solution(kk, self.xScaling, self.yScaling)
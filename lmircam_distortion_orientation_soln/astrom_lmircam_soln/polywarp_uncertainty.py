@@ -0,0 +1,119 @@
+# Uncertainties of the polywarp distortion coefficients Kx, Ky, and of the displacement field they
+# imply, by resampling the matched pinhole coordinates: jackknife (leave-one-out) refits come in
+# closed form from a single QR factorization of the design matrix, and bootstrap refits are done
+# in batches (optionally over a pool of processes) from precomputed per-point products.
+
+import multiprocessing
+import numpy as np
+from scipy.linalg import solve_triangular
+from astrom_lmircam_soln import polywarp
+from astrom_lmircam_soln import make_barb_plot
+
+def _unscale_samples(kk,xScaling,yScaling):
+    # (numSamples, numTerms, 2) scaled solutions -> kx, ky samples of shape (numSamples, degree+1, degree+1)
+    samples = [polywarp.unscale_solution(k, xScaling, yScaling) for k in kk]
+    return np.array([kx for kx, ky in samples]), np.array([ky for kx, ky in samples])
+
+def jackknife_coeffs(xi,yi,xo,yo,degree=3):
+    '''
+    Leave-one-out refits of polywarp.polywarp(xi,yi,xo,yo,degree). Each
+    refit is a rank-one downdate of the full fit,
+    k_(-i) = k - (U^T U)^-1 u_i r_i/(1-h_i), with everything taken from one
+    QR factorization U = QR, so no refit is actually done.
+    Returns kxSamples, kySamples, each (len(xo), degree+1, degree+1);
+    use with jackknife=True in coeff_covariance and displacement_uncertainty_map.
+    '''
+    uu, x, xScaling, yScaling = polywarp.scaled_problem(xi,yi,xo,yo,degree)
+    qq, rr = np.linalg.qr(uu)
+    kk = solve_triangular(rr, np.dot(qq.T, x))
+    residuals = x-np.dot(uu, kk)
+    leverage = np.sum(qq**2, axis=1)
+    # column i of gg is (U^T U)^-1 u_i
+    gg = solve_triangular(rr, qq.T)
+    kkLeaveOneOut = kk[None,:,:]-gg.T[:,:,None]*(residuals/(1.-leverage)[:,None])[:,None,:]
+    return _unscale_samples(kkLeaveOneOut, xScaling, yScaling)
+
+# per-point products shared with the bootstrap workers
+_bootstrap_products = None
+
+def _init_bootstrap_worker(products):
+    global _bootstrap_products
+    _bootstrap_products = products
+
+def _bootstrap_batch(args):
+    # solve the refits for one batch of bootstrap samples, given as counts of each point
+    counts, = args
+    outerUU, outerUx, numTerms = _bootstrap_products
+    utu = np.dot(counts, outerUU).reshape(-1, numTerms, numTerms)
+    utx = np.dot(counts, outerUx).reshape(-1, numTerms, 2)
+    return np.linalg.solve(utu, utx)
+
+def bootstrap_coeffs(xi,yi,xo,yo,degree=3,numSamples=1000,batchSize=100,processes=1,seed=None):
+    '''
+    Bootstrap refits of polywarp.polywarp(xi,yi,xo,yo,degree): each sample
+    redraws the matched points with replacement. A sample's normal
+    equations are its point counts times precomputed per-point products
+    u_i u_i^T and u_i x_i, so a whole batch of samples is one matrix
+    product and one batched solve; batches are spread over a pool of
+    processes if processes > 1.
+    Returns kxSamples, kySamples, each (numSamples, degree+1, degree+1)
+    '''
+    uu, x, xScaling, yScaling = polywarp.scaled_problem(xi,yi,xo,yo,degree)
+    numPoints, numTerms = uu.shape
+    products = ((uu[:,:,None]*uu[:,None,:]).reshape(numPoints, -1),
+                (uu[:,:,None]*x[:,None,:]).reshape(numPoints, -1),
+                numTerms)
+
+    randomState = np.random.RandomState(seed)
+    batches = []
+    for start in range(0, numSamples, batchSize):
+        thisBatch = min(batchSize, numSamples-start)
+        batches.append((randomState.multinomial(numPoints, np.ones(numPoints)/numPoints, size=thisBatch).astype(np.float64),))
+
+    if processes == 1:
+        _init_bootstrap_worker(products)
+        results = [_bootstrap_batch(batch) for batch in batches]
+    else:
+        pool = multiprocessing.Pool(processes, _init_bootstrap_worker, (products,))
+        try:
+            results = pool.map(_bootstrap_batch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    return _unscale_samples(np.concatenate(results), xScaling, yScaling)
+
+def _sample_variance(samples,jackknife):
+    # variance over the first axis, for bootstrap or jackknife samples
+    if jackknife:
+        return np.var(samples, axis=0)*(len(samples)-1)
+    return np.var(samples, axis=0, ddof=1)
+
+def coeff_covariance(kSamples,jackknife=False):
+    '''
+    Covariance matrix of the flattened coefficients (kx.ravel() order)
+    from bootstrap or jackknife samples of kx (or ky)
+    '''
+    flat = np.reshape(kSamples, (len(kSamples), -1))
+    deviations = flat-flat.mean(axis=0)
+    cov = np.dot(deviations.T, deviations)
+    if jackknife:
+        return cov*(len(flat)-1.)/len(flat)
+    return cov/(len(flat)-1.)
+
+def displacement_uncertainty_map(kxSamples,kySamples,xGrid=None,yGrid=None,jackknife=False):
+    '''
+    Uncertainty (1 sigma, pixels) of the mapped positions xi, yi at each
+    point of a grid of xo, yo, from bootstrap or jackknife samples of kx,
+    ky. The default grid is the one of the barb plots (make_barb_plot.barb_grid).
+    Returns sigmaX, sigmaY with the shape of the grid.
+    '''
+    if xGrid is None or yGrid is None:
+        xGrid, yGrid = make_barb_plot.barb_grid()[0:2]
+    gridShape = np.shape(xGrid)
+    uu = polywarp.polywarp_design_matrix(np.ravel(xGrid), np.ravel(yGrid), np.shape(kxSamples)[-1]-1)
+    # mapped positions for every sample: (numSamples, numGridPoints)
+    xMapped = np.dot(np.reshape(kxSamples, (len(kxSamples), -1)), uu.T)
+    yMapped = np.dot(np.reshape(kySamples, (len(kySamples), -1)), uu.T)
+    sigmaX = np.sqrt(_sample_variance(xMapped, jackknife)).reshape(gridShape)
+    sigmaY = np.sqrt(_sample_variance(yMapped, jackknife)).reshape(gridShape)
+    return sigmaX, sigmaY
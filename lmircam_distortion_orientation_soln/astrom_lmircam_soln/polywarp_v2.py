@@ -2,6 +2,7 @@
 
 import numpy as np
 import pylab as plt
+from astrom_lmircam_soln import polywarp as polywarp_module
 
 #from numpy.polynomial.polynomial import polyvander
 #from numpy.polynomial.polynomial import polyvander2d
@@ -20,17 +21,26 @@ import pylab as plt
 # xf,yf=applywarp(xo,yo,kx,ky)
 
 #** This hasn't been exhaustively tested, but i think it's ok **
-def applywarp(xo,yo,kx,ky):
-    np1=np.shape(kx)[0]
-    n=np1#-1
+def applywarp(xo,yo,kx,ky,out=None,chunkSize=65536):
+    # xi = sum over j,i of kx[j,i]*xo^j*yo^i (same for yi with ky), i.e. polyval2d(xo,yo,kx),
+    # evaluated by Horner's scheme in both variables, chunk by chunk, in preallocated
+    # buffers (so large point arrays don't pay for a temporary per term)
+    # out: optional (xi, yi) arrays (of size np.size(xo)) to write into
+    # (see benchmark_applywarp for a comparison with polyval2d)
+    xo = np.ravel(np.asarray(xo, dtype=np.float64))
+    yo = np.ravel(np.asarray(yo, dtype=np.float64))
     m=np.size(xo)
-    xi=np.zeros(m)
-    yi=np.zeros(m)
-    for i in range(n):
-        for j in range(n):
-            xi=xi+kx[j,i]*(xo**j)*(yo**i)
-            #print xi
-            yi=yi+ky[j,i]*xo**j*yo**i
+    if out is None:
+        xi=np.zeros(m)
+        yi=np.zeros(m)
+    else:
+        xi,yi=out
+    chunkSize=min(chunkSize,max(m,1))
+    inner=np.empty(chunkSize)
+    for start in range(0,m,chunkSize):
+        stop=min(start+chunkSize,m)
+        for coeffs,result in ((kx,xi),(ky,yi)):
+            _horner2d(xo[start:stop],yo[start:stop],coeffs,result[start:stop],inner[:stop-start])
     # this python indexing is really confusing!
     # Seems to work now, though!
     # xi and yi are reversed
@@ -38,6 +48,18 @@ def applywarp(xo,yo,kx,ky):
     return xi,yi
 #    return yi,xi
 
+def _horner2d(x,y,c,result,inner):
+    # result[:] = sum over j,i of c[j,i]*x^j*y^i; inner is a scratch buffer like result
+    nj,ni=np.shape(c)
+    result[:]=0.
+    for j in range(nj-1,-1,-1):
+        inner[:]=c[j,ni-1]
+        for i in range(ni-2,-1,-1):
+            inner*=y
+            inner+=c[j,i]
+        result*=x
+        result+=inner
+
 #def polyvander2d(x,y,deg):
 #    # from future version of numpy
 #    ideg = [int(d) for d in deg]
@@ -57,77 +79,9 @@ def applywarp(xo,yo,kx,ky):
 
 
 def polywarp(xi,yi,xo,yo, degree):
-#if (1):
-#    xi=np.arange(10)+5
-#    yi=np.arange(10)
-#    xo=np.arange(10)#+5.
-#    yo=np.arange(10)
-#    
-#    xi = np.array([24, 35, 102, 92])
-#    yi = np.array([81, 24, 25, 92])
-#    xo = np.array([61, 62, 143, 133])
-#    yo = np.array([89, 34, 38, 105])
-#     
-#    degree=1
-    
-    
-    m = np.size(xi) # no. of points
-# ** error checking. check no.s of elts.
-#    if (np.size(xo) <> m):
-#        print 'no. of elements must be same in xo,yo,xi,yi'
-#        stop()
-    
-# 
-    n = degree        #;use halls notation
-    n2=(n+1)**2
-    #** if n2 gt m then message, '# of points must be ge (degree+1)^2.'
-    if (n2>m):
-        print # of points must be >= (degree+1)^2.'
-        stop()
-        
-
-    x = np.transpose(np.array([np.transpose(xi[:]),np.transpose(yi[:])]))
-    u = np.transpose(np.array([np.transpose(xo[:]),np.transpose(yo[:])]))
-
-    ut=np.zeros((m,n2)) #;transpose of U
-    u2i = np.zeros(n+1)    #;[1,u2i,u2i^2,...]
-    
-    for i in np.arange(0,m):
-        u2i[0]=1 # ;init u2i
-        zz = u[i,1]
-        for j in np.arange(1,n+1): u2i[j]=u2i[j-1]*zz
-        ut[i,0:n+1]=u2i # ;evaluate 0 th power separately
-        for j in np.arange(1,n+1): ut[i,j*(n+1):j*(n+1)+n+1]=u2i*u[i,0]**j # ;fill ut=u0i^j * U2i
-#    #
-    # above is correct, by c.f. IDL
-
-#    ut=polyvander2d(x,u,(n,n))
-#    mut=np.matrix(ut)
-    
-    uu = np.dot(np.transpose(ut),ut) # ;big u
- #   uu=mut*mut.transpose()
-    
-    kk = np.linalg.inv(uu) #**** need to add error checking
-    okk=kk
-    
-    kk = np.dot(ut,kk)
-    #fkk = np.matrix(kk)*np.matrix(ut)
-    #kk=0
-    #kk=fkk
-    #fkk=0
-    
-    #kx = np.zeros(n+1,n+1) + (np.multiply(kk,np.transpose(x[:,0])))
-    #ky = np.zer
-    nkk=np.matrix(np.reshape(kk,-1))
-    xT=np.matrix(x).transpose()
-    #kx = np.zeros(n+1,n+1) + (xT[0,:]*kk)
-    #ky = np.zeros(n+1,n+1) + (xT[1,:]*kk)
-    
-    
-    kx=np.reshape( np.matrix(kk.T)*np.matrix(xT[0,:].T) ,(n+1,n+1))
-    ky=np.reshape( np.matrix(kk.T)*np.matrix(xT[1,:].T), (n+1,n+1))
-    
-    return kx.A,ky.A # turn back into arrays
+    # now just calls the vectorized least-squares version in polywarp.py (same
+    # coefficient convention), so that there is only one implementation
+    return polywarp_module.polywarp(np.ravel(xi),np.ravel(yi),np.ravel(xo),np.ravel(yo),degree=degree)
     
     
 def testpw():
@@ -167,3 +121,28 @@ def testpw():
     #print "residuals: dx: %.2f, dy: %.2f"%(np.sqrt(dx2),np.sqrt(dy2))
     
     
+
+
+def benchmark_applywarp(numPoints=10**6,degree=3):
+    # times applywarp against numpy.polynomial.polynomial.polyval2d on random
+    # points over the detector, and checks that they agree
+    import time
+    kx=np.random.normal(size=(degree+1,degree+1))*2048.**-np.add.outer(np.arange(degree+1),np.arange(degree+1))
+    ky=np.random.normal(size=(degree+1,degree+1))*2048.**-np.add.outer(np.arange(degree+1),np.arange(degree+1))
+    xo=np.random.uniform(0,2048,numPoints)
+    yo=np.random.uniform(0,2048,numPoints)
+    xi=np.empty(numPoints)
+    yi=np.empty(numPoints)
+
+    startTime=time.time()
+    applywarp(xo,yo,kx,ky,out=(xi,yi))
+    timeHorner=time.time()-startTime
+
+    startTime=time.time()
+    xiRef=np.polynomial.polynomial.polyval2d(xo,yo,kx)
+    yiRef=np.polynomial.polynomial.polyval2d(xo,yo,ky)
+    timePolyval=time.time()-startTime
+
+    maxDiff=max(np.abs(xi-xiRef).max(),np.abs(yi-yiRef).max())
+    print("applywarp: %.3f s, polyval2d: %.3f s, max difference %.2e (%i points, degree %i)"%(timeHorner,timePolyval,maxDiff,numPoints,degree))
+    return timeHorner,timePolyval,maxDiff
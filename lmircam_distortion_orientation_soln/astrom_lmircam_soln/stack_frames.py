@@ -0,0 +1,39 @@
+# Python version of the stacking step in derotate_trapezium_data_ut_2016_11_12.pro (the median
+# of the frames taken at each dither position). Frames and stacks are kept in frame_dtype
+# (float32), which halves the memory of the cubes compared with IDL's or numpy's default
+# doubles; means are accumulated in accum_dtype (float64).
+
+import numpy as np
+from astropy.io import fits
+from astrom_lmircam_soln import frame_dtype, accum_dtype
+
+def median_stack(fileNames, dtype=frame_dtype):
+    # median of the frames in a list of FITS files
+    firstFrame = fits.getdata(fileNames[0], 0)
+    cube = np.empty((len(fileNames),)+firstFrame.shape, dtype=dtype)
+    cube[0] = firstFrame
+    for sliceNum in range(1, len(fileNames)):
+        cube[sliceNum] = fits.getdata(fileNames[sliceNum], 0)
+    return np.median(cube, axis=0).astype(dtype)
+
+def mean_stack(fileNames, dtype=frame_dtype):
+    # mean of the frames in a list of FITS files, read one at a time
+    total = None
+    for fileName in fileNames:
+        frame = fits.getdata(fileName, 0)
+        if total is None:
+            total = np.zeros(frame.shape, dtype=accum_dtype)
+        total += frame
+    return (total/len(fileNames)).astype(dtype)
+
+def make_dither_medians(frameFileNames, framesPerDither, outFileNames, dtype=frame_dtype):
+    '''
+    Median-combine consecutive runs of framesPerDither frames (one run per
+    dither position) and write each median to the corresponding file in
+    outFileNames, with the header of the first frame of the run.
+    '''
+    for ditherPos in range(len(outFileNames)):
+        print('Median of dither position '+str(ditherPos)+' ...')
+        ditherFiles = frameFileNames[ditherPos*framesPerDither:(ditherPos+1)*framesPerDither]
+        header = fits.getheader(ditherFiles[0], 0)
+        fits.writeto(outFileNames[ditherPos], median_stack(ditherFiles, dtype), header, overwrite=True)
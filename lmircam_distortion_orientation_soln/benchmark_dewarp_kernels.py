@@ -0,0 +1,85 @@
+# This compares the resampling kernels available for dewarping (spline interpolation of order 1 and
+# 3, and the precomputed nearest, bilinear, bicubic and Lanczos-3 weight tables) on a synthetic
+# image of point sources, warped with the LEECH distortion solution. For each kernel it prints the
+# time per frame, and the flux and astrometric errors of the sources after dewarping, so that
+# quick-look and final reductions can pick a kernel based on measured trade-offs.
+
+import time
+import numpy as np
+from astrom_lmircam_soln import dewarp
+from astrom_lmircam_soln import distortion_solution
+
+
+#####################################################################
+# SET UP A SYNTHETIC POINT-SOURCE IMAGE
+
+# coefficients from the LEECH pipeline based on Maire+ 2015 measurements (see distortion_solution.leech_Kx, leech_Ky)
+solution = distortion_solution.leech_solution()
+P = solution.P
+Q = solution.Q
+
+imShape = (1024, 1024)
+numFramesTimed = 5 # frames to average the timing over
+sigmaPSF = 1.5 # Gaussian PSF width (pix)
+boxHalfWidth = 6 # half-width of the box for photometry and centroiding (pix)
+
+# true (dewarped) source positions on a jittered grid, away from the edges
+np.random.seed(1)
+xTrue, yTrue = np.meshgrid(np.arange(40., imShape[1]-40., 40.), np.arange(40., imShape[0]-40., 40.))
+xTrue = np.ravel(xTrue)+np.random.uniform(-0.5, 0.5, xTrue.size)
+yTrue = np.ravel(yTrue)+np.random.uniform(-0.5, 0.5, yTrue.size)
+
+# where they land on the raw (warped) detector
+xRaw, yRaw = dewarp.warp_points(xTrue, yTrue, P, Q)
+
+# render the raw image; each source has unit flux
+yy, xx = np.indices(imShape)
+rawImage = np.zeros(imShape)
+for xs, ys in zip(xRaw, yRaw):
+    x0, y0 = int(round(xs)), int(round(ys))
+    box = (slice(y0-boxHalfWidth, y0+boxHalfWidth+1), slice(x0-boxHalfWidth, x0+boxHalfWidth+1))
+    rawImage[box] += np.exp(-((xx[box]-xs)**2+(yy[box]-ys)**2)/(2.*sigmaPSF**2))/(2.*np.pi*sigmaPSF**2)
+
+# a source covering more pixels after dewarping gets more flux; correct for the pixel area
+# so that a perfect kernel gives unit flux
+dxtdx, dxtdy, dytdx, dytdy = dewarp.warp_jacobian(xTrue, yTrue, P, Q)
+pixelArea = np.abs(dxtdx*dytdy-dxtdy*dytdx)
+
+
+#####################################################################
+# DEWARP WITH EACH KERNEL AND MEASURE
+
+def measure_sources(image):
+    # aperture flux and first-moment centroid in a box around each true position
+    flux, xCen, yCen = [], [], []
+    for xs, ys in zip(xTrue, yTrue):
+        x0, y0 = int(round(xs)), int(round(ys))
+        box = (slice(y0-boxHalfWidth, y0+boxHalfWidth+1), slice(x0-boxHalfWidth, x0+boxHalfWidth+1))
+        cutout = image[box]
+        flux.append(cutout.sum())
+        xCen.append((cutout*xx[box]).sum()/cutout.sum())
+        yCen.append((cutout*yy[box]).sum()/cutout.sum())
+    return np.array(flux), np.array(xCen), np.array(yCen)
+
+coords = dewarp.make_dewarp_coordinates(imShape, P, Q)
+
+print('%-14s %12s %12s %14s %14s' % ('kernel', 'setup (s)', 'frame (s)', 'flux err (%)', 'astrom err (pix)'))
+for kernelName in ['spline order 1', 'spline order 3', 'nearest', 'bilinear', 'bicubic', 'lanczos3']:
+    startTime = time.time()
+    if kernelName.startswith('spline'):
+        order = int(kernelName[-1])
+        dewarpFcn = lambda image: np.squeeze(dewarp.dewarp_with_precomputed_coords(image, coords, order=order))
+    else:
+        op, outShape = dewarp.make_dewarp_operator(imShape, coords, kernel=kernelName)
+        dewarpFcn = lambda image: dewarp.dewarp_with_operator(image, op, outShape)
+    setupTime = time.time()-startTime
+
+    startTime = time.time()
+    for frameNum in range(numFramesTimed):
+        dewarpedImage = dewarpFcn(rawImage)
+    frameTime = (time.time()-startTime)/numFramesTimed
+
+    flux, xCen, yCen = measure_sources(dewarpedImage)
+    fluxErr = 100.*np.sqrt(np.mean((flux*pixelArea-1.)**2))
+    astromErr = np.sqrt(np.mean((xCen-xTrue)**2+(yCen-yTrue)**2))
+    print('%-14s %12.3f %12.3f %14.3f %14.4f' % (kernelName, setupTime, frameTime, fluxErr, astromErr))
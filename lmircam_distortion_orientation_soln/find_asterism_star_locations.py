@@ -32,6 +32,9 @@ for ditherPos in range(0,number_of_dithers):
 
     # find star locations; input parameters may need some find-tuning to get good results
     xCoordsAsterism, yCoordsAsterism = find_pinhole_centroids.find_psf_centers(imageMedian,20.,15000.) 
+    # (alternatively, run this on raw frames and correct the coordinates directly, without resampling the images:
+    # xCoordsAsterism, yCoordsAsterism = dewarp.dewarp_points(xCoordsAsterism, yCoordsAsterism, np.array(Kx).T, np.array(Ky).T)
+    # with Kx, Ky from find_dewarp_solution.py; the derotation then has to be applied to the coordinates too)
     star_coords_every_dither[keyName] = np.transpose([xCoordsAsterism, yCoordsAsterism])
     print(np.transpose([xCoordsAsterism,yCoordsAsterism]))
     print("Please check the plot and note true positives among the printed star positions. Close the plot to continue.")
@@ -10,6 +10,7 @@ from astrom_lmircam_soln import polywarp
 from astrom_lmircam_soln import polywarp_v2 # the check for polywarp
 from astrom_lmircam_soln import dewarp
 from astrom_lmircam_soln import make_barb_plot
+from astrom_lmircam_soln import distortion_solution
 from astropy.io import fits
 import matplotlib.pyplot as plt
 import pickle
@@ -21,7 +22,7 @@ import pickle
 # (note this section will require multiple run-throughs until optimal parameters are specified: the ideal grid coords, the missed pinhole coords, etc.)
 
 hdul = fits.open(calibrated_pinholes_data_stem+'pinhole_image_median_vignettingBlocked.fits') # median image of pinholes, with vignetted regions masked
-imagePinholes = hdul[0].data.copy()
+imagePinholes = np.array(hdul[0].data, dtype=frame_dtype) # float32; see frame_dtype in astrom_lmircam_soln/__init__.py
 xCoordsIdealFullGrid, yCoordsIdealFullGrid = find_pinhole_centroids.put_down_grid_guesses(48.0,0.65) # sets down an 'ideal' set of pinholes made to match the real pinholes as closely as possible
 xCoordsFoundAutomated, yCoordsFoundAutomated = find_pinhole_centroids.find_psf_centers(imagePinholes,20.,50000.) # finds the actual st of pinholes
 
@@ -60,11 +61,32 @@ Kx, Ky = polywarp.polywarp(xFound_sorted,
                            yIdeal_sorted,
                            degree=3)
 
+# optional: robust fit that down-weights false detections and mispaired pinholes, and returns which pairs were kept
+#Kx, Ky, inliers = polywarp.polywarp_robust(xFound_sorted, yFound_sorted, xIdeal_sorted, yIdeal_sorted, degree=3, method='tukey')
+#print('rejected pairs: ', np.transpose([xFound_sorted[~inliers], yFound_sorted[~inliers]]))
+
+# optional: choose the degree by cross-validation instead of hardcoding it (prints the held-out residuals for degrees 1-7)
+#degreeBest, cvResiduals, Kx, Ky = polywarp.select_polywarp_degree(xFound_sorted, yFound_sorted, xIdeal_sorted, yIdeal_sorted)
+#print(degreeBest, cvResiduals)
+
+# do the inverse fit, to find the coefficients that take us from warped coords --> dewarped coords
+KxInv, KyInv = polywarp.polywarp(xIdeal_sorted,
+                                 yIdeal_sorted,
+                                 xFound_sorted,
+                                 yFound_sorted,
+                                 degree=3)
+
+# keep the forward and inverse coefficients together; the solution object takes care of the transposes
+# the dewarp module needs (due to a coefficient definition change btwn Python and IDL), and makes
+# the coordinate maps etc. once, when they are first needed
+solution = distortion_solution.DistortionSolution(Kx, Ky, KxInv, KyInv,
+                                                  description='pinholes '+dateStringPinholes)
+solution.save(save_pinholes_data_stem+'distortion_solution_'+dateStringPinholes+'.npz') # read back with distortion_solution.load_distortion_solution
+
 # map the coordinates that define the entire image plane
 # note the below couple functions appear in the LEECH pipeline, and the above Kx, Ky are the same as the Kx, Ky in the LEECH pipeline
-dewarp_coords = dewarp.make_dewarp_coordinates(imagePinholes.shape,
-                                               np.array(Kx).T,
-                                               np.array(Ky).T) # transposed due to a coefficient definition change btwn Python and IDL
+dewarp_coords = solution.coordinates(imagePinholes.shape,
+                                     dtype=frame_dtype) # float32 maps are good to better than a milli-pixel (see dewarp.test_float32_coords)
 
 # optional: view the dewarped pinhole image as a check
 #dewarpedImg = dewarp.dewarp_with_precomputed_coords(imagePinholes,dewarp_coords,order=3) # np.squeeze shouldn't be a problem for displaying, right?
@@ -75,6 +97,11 @@ dewarp_coords = dewarp.make_dewarp_coordinates(imagePinholes.shape,
 #####################################################################
 # APPLY THE DEWARP SOLUTION TO THE SCIENCE IMAGES 
 '''
+# compile the coordinates into a sparse interpolation operator once (this can be saved with
+# dewarp.save_dewarp_operator and read back with dewarp.load_dewarp_operator in later runs)
+dewarp_op, dewarp_outshape = solution.operator(imagePinholes.shape,
+                                               kernel='bicubic')
+
 for frameNum in range(1892,2252):
     print('Dewarping frame %05i'%frameNum+'...')
 
@@ -84,14 +111,36 @@ for frameNum in range(1892,2252):
                                        0, header=True)
 
     # dewarp the image
-    dewarpedAsterism = dewarp.dewarp_with_precomputed_coords(imageAsterism,
-                                                             dewarp_coords,
-                                                             order=3)
+    dewarpedAsterism = dewarp.dewarp_with_operator(imageAsterism,
+                                                   dewarp_op,
+                                                   dewarp_outshape)
 
     # write out
     fits.writeto(calibrated_trapezium_data_stem+
                  'step02_dewarped/lm_161112_'+'%05i'%frameNum+'.fits',
                  np.squeeze(dewarpedAsterism), header, clobber=True)
+
+# alternatively, spread the frames over all cores (the coordinate maps are shared with the workers through memory-mapped files)
+frameNums = range(1892,2252)
+dewarp.dewarp_batch([calibrated_trapezium_data_stem+'step01_darkSubtBadPixCorrect/lm_161112_'+'%05i'%frameNum+'.fits' for frameNum in frameNums],
+                    dewarp_coords,
+                    order=3,
+                    outFileNames=[calibrated_trapezium_data_stem+'step02_dewarped/lm_161112_'+'%05i'%frameNum+'.fits' for frameNum in frameNums])
+
+# alternatively, dewarp and derotate in one interpolation, in place of the step02 write-out and the
+# IDL derotation (derotate_trapezium_data_ut_2016_11_12.pro); this goes straight to step03
+for frameNum in range(1892,2252):
+    imageAsterism, header = fits.getdata(calibrated_trapezium_data_stem+
+                                       'step01_darkSubtBadPixCorrect/lm_161112_'+'%05i'%frameNum+'.fits',
+                                       0, header=True)
+    derotatedAsterism = dewarp.dewarp_derotate(imageAsterism,
+                                               solution.P,
+                                               solution.Q,
+                                               header['LBT_PARA'], # parallactic angle
+                                               order=3)
+    fits.writeto(calibrated_trapezium_data_stem+
+                 'step03_derotate/lm_161112_'+'%05i'%frameNum+'.fits',
+                 derotatedAsterism, header, clobber=True)
 '''
 
 #####################################################################
@@ -101,18 +150,10 @@ for frameNum in range(1892,2252):
 # make an even grid to tack onto the pre-dewarped image; these grid points are the locations where the barbs will be
 x_vec_grid_predewarp, y_vec_grid_predewarp, xIntervalsOnly, yIntervalsOnly = make_barb_plot.barb_grid()
 
-# do the inverse fit, to find the coefficients that take us from warped coords --> dewarped coords
-KxInv, KyInv = polywarp.polywarp(xIdeal_sorted,
-                                 yIdeal_sorted,
-                                 xFound_sorted,
-                                 yFound_sorted,
-                                 degree=3)
-
-# map the points from the pre-dewarp barb grid to the post-dewarp grid 
-dewarp_coords_inv = dewarp.make_dewarp_coordinates_sparseGrid(xIntervalsOnly,
-                                                              yIntervalsOnly,
-                                                              np.array(KxInv).T,
-                                                              np.array(KyInv).T)
+# map the points from the pre-dewarp barb grid to the post-dewarp grid, with the inverse coefficients
+dewarp_coords_inv = solution.sparse_grid_coordinates(xIntervalsOnly,
+                                                     yIntervalsOnly,
+                                                     inverse=True)
 
 # remove stray array dimensions of thickness 1
 x_vec_grid_postdewarp = np.squeeze(dewarp_coords_inv)[1,:,:]